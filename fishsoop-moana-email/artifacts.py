@@ -0,0 +1,109 @@
+import io
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from ops_mangopare.aws import get_s3_client, TRANSFER_CONFIG
+
+# Uploads run here so archiving to S3 overlaps with plotting and sending
+_ARCHIVE_EXECUTOR = ThreadPoolExecutor(max_workers=8)
+
+
+class Artifact(object):
+    """
+    A file made while processing a deployment (csv export, plot), kept in
+    memory so it can be attached to the email without a round trip
+    through S3 and /tmp.  str() of an artifact is its name, which is what
+    the status log and sent ledger record.
+    Input:
+        name: filename used for the attachment
+        data: file contents as bytes, or a seekable binary file object
+        (e.g. a tempfile.SpooledTemporaryFile) which the artifact then
+        owns.  A file is uploaded straight from the file and only read
+        into memory when .data is asked for (attaching it to the
+        email); close() releases it.
+        content_type: MIME type of data
+        bucket_name, key: where the artifact is archived in S3
+    """
+
+    def __init__(self, name, data,
+                 content_type='application/octet-stream',
+                 bucket_name=None,
+                 key=None,
+                 logger=logging):
+        self.name = name
+        self.fileobj = None
+        if hasattr(data, 'read'):
+            self.fileobj, data = data, None
+        self._data = data
+        self._lock = threading.Lock()
+        self.content_type = content_type
+        self.bucket_name = bucket_name
+        self.key = key
+        self.logger = logger
+        self.future = None
+
+    def __str__(self):
+        return(self.name)
+
+    def __repr__(self):
+        return(f'Artifact({self.name!r}, {self.size} bytes)')
+
+    @property
+    def data(self):
+        """
+        The contents as bytes, read from the file every time if the
+        artifact is backed by one
+        """
+        if self.fileobj is None:
+            return(self._data)
+        with self._lock:
+            self.fileobj.seek(0)
+            return(self.fileobj.read())
+
+    @property
+    def size(self):
+        if self.fileobj is None:
+            return(len(self._data))
+        with self._lock:
+            return(self.fileobj.seek(0, io.SEEK_END))
+
+    def _put(self, fileobj):
+        get_s3_client().upload_fileobj(
+            fileobj, self.bucket_name, self.key,
+            ExtraArgs={'ContentType': self.content_type},
+            Config=TRANSFER_CONFIG)
+
+    def _upload(self):
+        if self.fileobj is None:
+            self._put(io.BytesIO(self._data))
+        else:
+            # the file has a single position, so reading .data waits
+            # for the upload
+            with self._lock:
+                self.fileobj.seek(0)
+                self._put(self.fileobj)
+        self.logger.error(f'In artifacts.py: archived {self.bucket_name}/{self.key}')
+
+    def archive(self):
+        """
+        Start uploading to bucket_name/key in the background
+        """
+        if self.bucket_name and self.key and not self.future:
+            self.future = _ARCHIVE_EXECUTOR.submit(self._upload)
+        return(self)
+
+    def wait(self):
+        """
+        Block until the upload started by archive() is done.  Raises
+        if the upload failed.
+        """
+        if self.future:
+            self.future.result()
+
+    def close(self):
+        """
+        Release the file behind the artifact, if there is one.  Call
+        after wait() and once the email is sent.
+        """
+        if self.fileobj is not None:
+            self.fileobj.close()
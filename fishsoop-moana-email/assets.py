@@ -0,0 +1,159 @@
+import os
+import time
+import logging
+import threading
+from concurrent.futures import Future
+from botocore.exceptions import ClientError
+from ops_mangopare.aws import get_s3_client
+from ops_mangopare.cache import get_local_cache
+
+REVALIDATE_SECONDS = float(os.environ.get('ASSET_REVALIDATE_SECONDS', 3600))
+
+# A missing or failed asset is not asked for again for this long
+MISS_SECONDS = float(os.environ.get('ASSET_MISS_SECONDS', 300))
+
+
+class AssetCache(object):
+    """
+    Static plotting and email assets (logos etc.) from S3.  Each asset
+    is downloaded and decoded once per container and kept in memory, and
+    also saved in the local /tmp cache (cache.LocalCache) so a new
+    container can start from the /tmp copy.  After revalidate_after
+    seconds the next request checks S3 with If-None-Match, so an
+    unchanged asset is never downloaded again.  If S3 cannot be reached
+    the cached copy keeps being used.  Only one thread fetches a given
+    asset at a time, others asking for it wait for that fetch; fetches
+    of different assets run in parallel.  An asset that could not be
+    fetched at all raises the same error again for retry_after seconds
+    instead of every caller retrying the GET.
+    Input:
+        bucket_name: bucket holding the assets
+        local_cache: cache.LocalCache for the persisted copies, the
+        process-wide one if None
+        revalidate_after: seconds between ETag checks against S3
+        retry_after: seconds a failed fetch is remembered
+    """
+
+    def __init__(self,
+                 bucket_name='fishsoop-qc-tools',
+                 local_cache=None,
+                 revalidate_after=REVALIDATE_SECONDS,
+                 retry_after=MISS_SECONDS,
+                 logger=logging):
+        self.bucket_name = bucket_name
+        self.local_cache = local_cache or get_local_cache()
+        self.revalidate_after = revalidate_after
+        self.retry_after = retry_after
+        self.logger = logger
+        self._entries = {}
+        # key -> (time, exception) of the last failed fetch
+        self._misses = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def _load_local(self, key):
+        path, etag = self.local_cache.latest(self.bucket_name, key)
+        if not path:
+            return(None)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return(None)
+        # not checked yet in this container
+        return({'data': data, 'etag': etag, 'checked': 0, 'decoded': {}})
+
+    def _save_local(self, key, entry):
+        try:
+            self.local_cache.put_bytes(self.bucket_name, key, entry['etag'], entry['data'])
+        except OSError as exc:
+            self.logger.warning(f'Could not save {key} in {self.local_cache.cache_dir}: {exc}')
+
+    def _revalidate(self, key, entry):
+        """
+        Returns the entry for key, downloading it only if it is new or
+        its ETag changed
+        """
+        kwargs = {'Bucket': self.bucket_name, 'Key': key}
+        if entry:
+            kwargs['IfNoneMatch'] = entry['etag']
+        try:
+            response = get_s3_client().get_object(**kwargs)
+        except ClientError as exc:
+            code = exc.response['Error']['Code']
+            if entry and code in ('304', 'NotModified'):
+                entry['checked'] = time.time()
+                return(entry)
+            if entry:
+                self.logger.warning(f'Could not revalidate {key}, using cached copy: {exc}')
+                return(entry)
+            raise exc
+        self.logger.error(f'In assets.py: downloaded {self.bucket_name}/{key}')
+        entry = {'data': response['Body'].read(), 'etag': response['ETag'],
+                 'checked': time.time(), 'decoded': {}}
+        self._save_local(key, entry)
+        return(entry)
+
+    def _fresh(self, entry):
+        return(entry is not None and time.time() - entry['checked'] <= self.revalidate_after)
+
+    def _get_entry(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if self._fresh(entry):
+                return(entry)
+            miss = self._misses.get(key)
+            if entry is None and miss and time.time() - miss[0] <= self.retry_after:
+                raise miss[1]
+            # one fetch per key, outside the lock
+            future = self._pending.get(key)
+            fetching = future is None
+            if fetching:
+                future = self._pending[key] = Future()
+        if not fetching:
+            return(future.result())
+        try:
+            entry = entry or self._load_local(key)
+            if not self._fresh(entry):
+                entry = self._revalidate(key, entry)
+            with self._lock:
+                self._entries[key] = entry
+                self._misses.pop(key, None)
+            future.set_result(entry)
+            return(entry)
+        except Exception as exc:
+            with self._lock:
+                self._misses[key] = (time.time(), exc)
+            future.set_exception(exc)
+            raise exc
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+
+    def get_bytes(self, key):
+        return(self._get_entry(key)['data'])
+
+    def get_decoded(self, key, decoder):
+        """
+        Returns decoder(bytes of key), decoding only when the asset is
+        first seen or has changed in S3
+        """
+        entry = self._get_entry(key)
+        name = getattr(decoder, '__qualname__', repr(decoder))
+        if name not in entry['decoded']:
+            entry['decoded'][name] = decoder(entry['data'])
+        return(entry['decoded'][name])
+
+
+_CACHES = {}
+_CACHES_LOCK = threading.Lock()
+
+
+def get_asset_cache(bucket_name='fishsoop-qc-tools'):
+    """
+    The AssetCache for bucket_name shared by the whole process
+    """
+    with _CACHES_LOCK:
+        if bucket_name not in _CACHES:
+            _CACHES[bucket_name] = AssetCache(bucket_name=bucket_name)
+        return(_CACHES[bucket_name])
@@ -0,0 +1,110 @@
+import io
+import os
+import threading
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+
+# Connection pool is shared by every thread in SendDataWrapper, so keep it
+# larger than max_workers times the transfer concurrency below
+S3_CONFIG = Config(
+    max_pool_connections=int(os.environ.get('S3_MAX_POOL_CONNECTIONS', 50)),
+    retries={'max_attempts': 10, 'mode': 'adaptive'},
+    tcp_keepalive=True)
+
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=8,
+    use_threads=True)
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_s3_client():
+    """
+    Returns the S3 client shared by the reader, plotter and mailer.
+    The client is created once per process, so warm Lambda invocations
+    reuse its connections instead of paying for a new TLS handshake.
+    boto3 clients are thread-safe, creating them is not, hence the lock.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = boto3.session.Session().client('s3', config=S3_CONFIG)
+    return _client
+
+
+def split_s3_path(path):
+    """
+    Split 's3://bucket/key' into bucket and key
+    """
+    bucket_name, object_key = path.replace('s3://', '').split('/', 1)
+    return bucket_name, object_key
+
+
+class S3RangeFile(io.RawIOBase):
+    """
+    Read-only, seekable file object over an S3 object that fetches only
+    the blocks that are actually read, with ranged GETs.  For reading a
+    file header (e.g. the metadata of a netCDF-4 file) without
+    downloading the whole object.
+    Input:
+        bucket_name, key: the object to read
+        block_size: bytes fetched per request
+        size: object size, taken from a HEAD request if None
+    """
+
+    def __init__(self, bucket_name, key, block_size=256 * 1024, size=None):
+        super().__init__()
+        self.bucket_name = bucket_name
+        self.key = key
+        self.block_size = block_size
+        self.s3_client = get_s3_client()
+        if size is None:
+            size = self.s3_client.head_object(Bucket=bucket_name, Key=key)['ContentLength']
+        self.size = size
+        self.position = 0
+        self.requests = 0
+        self._blocks = {}
+
+    def readable(self):
+        return(True)
+
+    def seekable(self):
+        return(True)
+
+    def tell(self):
+        return(self.position)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = max(0, offset)
+        return(self.position)
+
+    def _block(self, index):
+        if index not in self._blocks:
+            start = index * self.block_size
+            end = min(start + self.block_size, self.size) - 1
+            response = self.s3_client.get_object(Bucket=self.bucket_name, Key=self.key,
+                                                 Range=f'bytes={start}-{end}')
+            self._blocks[index] = response['Body'].read()
+            self.requests += 1
+        return(self._blocks[index])
+
+    def readinto(self, buffer):
+        view = memoryview(buffer).cast('B')
+        n = 0
+        while n < len(view) and self.position < self.size:
+            index, offset = divmod(self.position, self.block_size)
+            block = self._block(index)
+            chunk = block[offset:offset + len(view) - n]
+            view[n:n + len(chunk)] = chunk
+            n += len(chunk)
+            self.position += len(chunk)
+        return(n)
@@ -0,0 +1,224 @@
+"""
+Pre-rasterised land/coast images for the inset map in plot.py.
+
+Natural Earth land polygons are rasterised once, offline, into land
+masks for Australian and New Zealand waters at a few zoom levels, cut
+into tiles and stored as compressed numpy files.  At plot time the
+inset crops the tiles that cover its extent and draws them as one
+image under the scatter: no network access and no vector geometry work.
+
+Build the tiles into the deployment package (needs cartopy, shapely and
+Natural Earth data, so run it where those are available):
+    python basemap.py build --out basemap_data
+"""
+import os
+import sys
+import argparse
+import logging
+import functools
+import numpy as np
+
+# lon_min, lon_max (0-360), lat_min, lat_max covered by the tiles
+REGION = (100., 190., -60., 0.)
+
+# level: degrees per pixel, coarsest first
+LEVELS = {0: 0.05, 1: 0.01, 2: 0.0025}
+
+# pixels along each side of a tile
+TILE_PX = 1000
+
+LAND_RGBA = np.array([240, 240, 220, 255], dtype=np.uint8)
+COAST_RGBA = np.array([0, 0, 0, 255], dtype=np.uint8)
+
+DEFAULT_DIRS = [os.environ.get('BASEMAP_DIR', ''),
+                os.path.join(os.path.dirname(os.path.realpath(__file__)), 'basemap_data'),
+                '/tmp/basemap_data']
+
+
+def _tile_deg(level):
+    return(LEVELS[level] * TILE_PX)
+
+
+def _tile_file(data_dir, level, i, j):
+    return(os.path.join(data_dir, str(level), f'{i}_{j}.npz'))
+
+
+# a tile is TILE_PX**2 booleans (1 MB), so only keep the few the last
+# maps used
+@functools.lru_cache(maxsize=8)
+def _load_tile(data_dir, level, i, j):
+    """
+    Land mask of tile (i, j), row 0 at the north edge.  Tiles that
+    were not stored are all water.
+    """
+    filename = _tile_file(data_dir, level, i, j)
+    if not os.path.isfile(filename):
+        return(None)
+    with np.load(filename) as tile:
+        return(np.unpackbits(tile['mask'], axis=1)[:, :TILE_PX].astype(bool))
+
+
+class Basemap(object):
+    """
+    Land and coastline image for a map extent, built from the tiles
+    written by `python basemap.py build`.
+    Input:
+        data_dir: directory holding the tiles, by default the first of
+        $BASEMAP_DIR, basemap_data/ next to this file and /tmp/basemap_data
+        that has tiles in it
+        target_px: pixels wanted across the image; the coarsest level
+        giving at least this many is used
+    """
+
+    def __init__(self, data_dir=None, target_px=400, logger=logging):
+        self.data_dir = data_dir or self._find_data_dir()
+        self.target_px = target_px
+        self.logger = logger
+
+    @staticmethod
+    def _find_data_dir():
+        for data_dir in DEFAULT_DIRS:
+            if data_dir and os.path.isdir(os.path.join(data_dir, '0')):
+                return(data_dir)
+        return(None)
+
+    def available(self):
+        return(self.data_dir is not None)
+
+    def _choose_level(self, width_deg):
+        for level, res in sorted(LEVELS.items()):
+            if width_deg / res >= self.target_px:
+                return(level)
+        return(max(LEVELS))
+
+    def mask(self, box):
+        """
+        Land mask covering box = [lon_min, lon_max, lat_min, lat_max]
+        (longitudes 0-360), clipped to REGION.  Returns the mask, row 0
+        north, and its exact [lon_min, lon_max, lat_min, lat_max].
+        """
+        lon0 = max(box[0], REGION[0])
+        lon1 = min(box[1], REGION[1])
+        lat0 = max(box[2], REGION[2])
+        lat1 = min(box[3], REGION[3])
+        if lon0 >= lon1 or lat0 >= lat1:
+            return(None, None)
+        level = self._choose_level(lon1 - lon0)
+        res = LEVELS[level]
+        # pixel columns/rows counted from the region's west and north edges
+        col0 = int(np.floor((lon0 - REGION[0]) / res))
+        col1 = int(np.ceil((lon1 - REGION[0]) / res))
+        row0 = int(np.floor((REGION[3] - lat1) / res))
+        row1 = int(np.ceil((REGION[3] - lat0) / res))
+        mask = np.zeros((row1 - row0, col1 - col0), dtype=bool)
+        for i in range(row0 // TILE_PX, (row1 - 1) // TILE_PX + 1):
+            for j in range(col0 // TILE_PX, (col1 - 1) // TILE_PX + 1):
+                tile = _load_tile(self.data_dir, level, i, j)
+                if tile is None:
+                    continue
+                r0, c0 = i * TILE_PX, j * TILE_PX
+                rs = slice(max(row0, r0), min(row1, r0 + TILE_PX))
+                cs = slice(max(col0, c0), min(col1, c0 + TILE_PX))
+                mask[rs.start - row0:rs.stop - row0, cs.start - col0:cs.stop - col0] = \
+                    tile[rs.start - r0:rs.stop - r0, cs.start - c0:cs.stop - c0]
+        extent = [REGION[0] + col0 * res, REGION[0] + col1 * res,
+                  REGION[3] - row1 * res, REGION[3] - row0 * res]
+        return(mask, extent)
+
+    def image(self, box):
+        """
+        RGBA image of box: land filled, coastline pixels (land next to
+        water) dark, water transparent.  Returns the image and its
+        extent as in mask(), or (None, None) if box is outside REGION.
+        """
+        mask, extent = self.mask(box)
+        if mask is None:
+            return(None, None)
+        coast = np.zeros_like(mask)
+        coast[1:, :] |= mask[1:, :] & ~mask[:-1, :]
+        coast[:-1, :] |= mask[:-1, :] & ~mask[1:, :]
+        coast[:, 1:] |= mask[:, 1:] & ~mask[:, :-1]
+        coast[:, :-1] |= mask[:, :-1] & ~mask[:, 1:]
+        rgba = np.zeros(mask.shape + (4,), dtype=np.uint8)
+        rgba[mask] = LAND_RGBA
+        rgba[coast] = COAST_RGBA
+        return(rgba, extent)
+
+
+def build(out_dir, levels=None, logger=logging):
+    """
+    Rasterise Natural Earth 10m land into tiles under out_dir.  Polygons
+    are drawn with Agg, without antialiasing, onto a canvas the size of
+    a tile; tiles with no land are not written.
+    """
+    import cartopy.io.shapereader as shpreader
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.patches import PathPatch
+    from matplotlib.path import Path
+
+    shp = shpreader.natural_earth(resolution='10m', category='physical', name='land')
+    rings = []
+    for geom in shpreader.Reader(shp).geometries():
+        polygons = getattr(geom, 'geoms', [geom])
+        for polygon in polygons:
+            for ring in [polygon.exterior] + list(polygon.interiors):
+                coords = np.asarray(ring.coords)[:, :2]
+                # again shifted by 360 degrees for the part of the
+                # region east of the dateline
+                for shifted in (coords, coords + [360, 0]):
+                    rings.append((shifted, shifted.min(axis=0), shifted.max(axis=0)))
+
+    for level in (levels or sorted(LEVELS)):
+        tile_deg = _tile_deg(level)
+        n_rows = int(np.ceil((REGION[3] - REGION[2]) / tile_deg))
+        n_cols = int(np.ceil((REGION[1] - REGION[0]) / tile_deg))
+        os.makedirs(os.path.join(out_dir, str(level)), exist_ok=True)
+        for i in range(n_rows):
+            for j in range(n_cols):
+                lon0 = REGION[0] + j * tile_deg
+                lat1 = REGION[3] - i * tile_deg
+                lo = np.array([lon0, lat1 - tile_deg])
+                hi = np.array([lon0 + tile_deg, lat1])
+                # one compound path of the rings touching this tile,
+                # holes come out through the nonzero winding rule
+                tile_rings = [coords for coords, cmin, cmax in rings
+                              if np.all(cmin <= hi) and np.all(cmax >= lo)]
+                if not tile_rings:
+                    continue
+                codes = []
+                for coords in tile_rings:
+                    ring_codes = np.full(len(coords), Path.LINETO)
+                    ring_codes[0] = Path.MOVETO
+                    ring_codes[-1] = Path.CLOSEPOLY
+                    codes.append(ring_codes)
+                land = Path(np.concatenate(tile_rings), np.concatenate(codes))
+                fig = Figure(figsize=(TILE_PX / 100, TILE_PX / 100), dpi=100)
+                canvas = FigureCanvasAgg(fig)
+                ax = fig.add_axes([0, 0, 1, 1])
+                ax.set_axis_off()
+                ax.set_xlim(lon0, lon0 + tile_deg)
+                ax.set_ylim(lat1 - tile_deg, lat1)
+                ax.add_patch(PathPatch(land, facecolor='black', edgecolor='none',
+                                       antialiased=False))
+                canvas.draw()
+                mask = np.asarray(canvas.buffer_rgba())[:, :, 0] < 128
+                if mask.any():
+                    np.savez_compressed(_tile_file(out_dir, level, i, j),
+                                        mask=np.packbits(mask, axis=1))
+        logger.info(f'Built basemap level {level} in {out_dir}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build the inset map basemap tiles')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build', help='rasterise Natural Earth land into tiles')
+    build_parser.add_argument('--out', default=DEFAULT_DIRS[1], help='output directory')
+    build_parser.add_argument('--levels', type=int, nargs='*', help='levels to build (default all)')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    build(args.out, args.levels)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
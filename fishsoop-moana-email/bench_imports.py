@@ -0,0 +1,139 @@
+"""
+Cold-start import benchmark for the email Lambda.
+
+Each module is imported in a fresh interpreter, several times, and the
+median wall time is reported, together with the heaviest imports it
+pulled in (from python -X importtime).  It also checks that importing
+the Lambda modules does not load the plotting libraries, which should
+only be imported when a plot is actually made (see plot._import_plotting).
+
+Usage:
+    python bench_imports.py
+    python bench_imports.py --repeat 10 --budget ops_mangopare.wrapper=800
+
+Exits with status 1 if a module is over its budget (in ms) or loads a
+plotting library at import time, so it can be run as a regression check.
+"""
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+from testutils import package_path
+
+MODULES = ['ops_mangopare.aws',
+           'ops_mangopare.artifacts',
+           'ops_mangopare.smtppool',
+           'ops_mangopare.status',
+           'ops_mangopare.readers',
+           'ops_mangopare.plot',
+           'ops_mangopare.mails',
+           'ops_mangopare.wrapper']
+
+# Budgets in ms, override with --budget
+DEFAULT_BUDGETS = {'ops_mangopare.plot': 300,
+                   'ops_mangopare.wrapper': 2500}
+
+# Must not be in sys.modules after importing any of MODULES
+LAZY_MODULES = ['matplotlib', 'cartopy', 'cmocean', 'PIL', 'shapely']
+
+# Imports run when the first plot is made, reported separately
+PLOT_SNIPPET = 'import ops_mangopare.plot as p; p._import_plotting()'
+
+TIMER = """
+import sys, time, json
+t0 = time.perf_counter()
+{statement}
+elapsed = time.perf_counter() - t0
+lazy = [m for m in {lazy!r} if m in sys.modules]
+print(json.dumps({{'ms': elapsed * 1000, 'lazy_loaded': lazy}}))
+"""
+
+
+def _run(statement, env, importtime=False):
+    cmd = [sys.executable]
+    if importtime:
+        cmd += ['-X', 'importtime']
+    cmd += ['-c', TIMER.format(statement=statement, lazy=LAZY_MODULES)]
+    proc = subprocess.run(cmd, env=env, capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1])
+    return(json.loads(proc.stdout.strip().splitlines()[-1]), proc.stderr)
+
+
+def _heaviest(importtime_log, top):
+    """
+    Top-level imports with the largest cumulative time, in ms
+    """
+    rows = []
+    for line in importtime_log.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        if name.startswith(' ') and not name.startswith('  '):
+            rows.append((int(cumulative) / 1000, name.strip()))
+    return(sorted(rows, reverse=True)[:top])
+
+
+def benchmark(modules, repeat=5, top=5):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [package_path()] + [p for p in [env.get('PYTHONPATH')] if p])
+    results = {}
+    statements = [(module, f'import {module}') for module in modules]
+    statements.append(('first plot imports', PLOT_SNIPPET))
+    for name, statement in statements:
+        times = []
+        try:
+            for _ in range(repeat):
+                result, _ = _run(statement, env)
+                times.append(result['ms'])
+            result, log = _run(statement, env, importtime=True)
+        except RuntimeError as exc:
+            results[name] = {'error': str(exc)}
+            continue
+        results[name] = {'ms': statistics.median(times),
+                         'lazy_loaded': result['lazy_loaded'],
+                         'heaviest': _heaviest(log, top)}
+    return(results)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='fresh interpreters per module')
+    parser.add_argument('--top', type=int, default=5,
+                        help='heaviest imports listed per module')
+    parser.add_argument('--budget', action='append', default=[],
+                        metavar='MODULE=MS', help='import time budget')
+    parser.add_argument('modules', nargs='*', default=MODULES)
+    args = parser.parse_args(argv)
+    budgets = dict(DEFAULT_BUDGETS)
+    for item in args.budget:
+        module, ms = item.split('=')
+        budgets[module] = float(ms)
+
+    failures = []
+    results = benchmark(args.modules, repeat=args.repeat, top=args.top)
+    for name, result in results.items():
+        if 'error' in result:
+            print(f"{name:<30} FAILED: {result['error']}")
+            failures.append(name)
+            continue
+        budget = budgets.get(name)
+        flag = ''
+        if budget and result['ms'] > budget:
+            flag = f'  OVER BUDGET ({budget:.0f} ms)'
+            failures.append(name)
+        if name != 'first plot imports' and result['lazy_loaded']:
+            flag += f"  LOADS {', '.join(result['lazy_loaded'])} AT IMPORT"
+            failures.append(name)
+        print(f"{name:<30} {result['ms']:8.1f} ms{flag}")
+        for ms, module in result['heaviest']:
+            print(f'    {module:<40} {ms:8.1f} ms')
+    return(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,230 @@
+import os
+import re
+import time
+import uuid
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from ops_mangopare.aws import get_s3_client, TRANSFER_CONFIG
+
+CACHE_DIR = os.environ.get('LOCAL_CACHE_DIR', '/tmp/fishsoop_cache')
+
+# Lambda /tmp is 512 MB unless configured otherwise
+CACHE_MAX_BYTES = int(float(os.environ.get('LOCAL_CACHE_MAX_MB', 256)) * 1024 * 1024)
+
+# Writes for put_bytes_later, one at a time in the background
+_WRITER = ThreadPoolExecutor(max_workers=1, thread_name_prefix='cache-writer')
+
+
+class LocalCache(object):
+    """
+    Size-capped cache of S3 objects on local disk (/tmp in Lambda).
+    Every local copy the email Lambda makes goes through here, so warm
+    containers do not slowly fill their ephemeral storage, and a retry
+    of the same input is a cache hit instead of another download.
+    Entries are keyed by bucket, key and ETag, stored as
+    <cache_dir>/<hash of bucket/key>/<etag><extension of key>, so a
+    changed object is never served from an old copy.  When the cache is
+    over max_bytes the least recently used files are deleted.  The size
+    and last use of every file are kept in an in-process index, read
+    from disk once, so neither a lookup nor an eviction walks the cache
+    directory.
+    Input:
+        cache_dir: local directory for the cache
+        max_bytes: size cap for all files in cache_dir
+    """
+
+    def __init__(self,
+                 cache_dir=CACHE_DIR,
+                 max_bytes=CACHE_MAX_BYTES,
+                 logger=logging):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.logger = logger
+        self._lock = threading.RLock()
+        # path -> (size, mtime), see _entries
+        self._index = None
+
+    def _key_dir(self, bucket_name, key):
+        name = hashlib.sha1(f'{bucket_name}/{key}'.encode('utf-8')).hexdigest()
+        return(os.path.join(self.cache_dir, name))
+
+    def _path(self, bucket_name, key, etag):
+        etag = re.sub(r'[^A-Za-z0-9-]', '_', etag.strip('"'))
+        ext = os.path.splitext(key)[1]
+        return(os.path.join(self._key_dir(bucket_name, key), f'{etag}{ext}'))
+
+    def _entries(self):
+        """
+        The index of cached files, read from cache_dir the first time.
+        Call with _lock held.
+        """
+        if self._index is None:
+            self._index = {}
+            for root, _, names in os.walk(self.cache_dir):
+                for name in names:
+                    if '.part-' in name:
+                        continue
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    self._index[path] = (stat.st_size, stat.st_mtime)
+        return(self._index)
+
+    def _note(self, path, size=None):
+        """
+        Record path in the index as used just now
+        """
+        with self._lock:
+            entries = self._entries()
+            if size is None and path in entries:
+                size = entries[path][0]
+            if size is None:
+                try:
+                    size = os.path.getsize(path)
+                except OSError:
+                    return
+            entries[path] = (size, time.time())
+
+    def _touch(self, path):
+        try:
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self._entries().pop(path, None)
+            return(False)
+        self._note(path)
+        return(True)
+
+    def lookup(self, bucket_name, key, etag):
+        """
+        Path of the cached copy of bucket_name/key at etag, or None
+        """
+        path = self._path(bucket_name, key, etag)
+        if self._touch(path):
+            return(path)
+        return(None)
+
+    def latest(self, bucket_name, key):
+        """
+        (path, etag) of the most recent cached copy of bucket_name/key
+        whatever its ETag, or (None, None)
+        """
+        key_dir = self._key_dir(bucket_name, key)
+        try:
+            names = [name for name in os.listdir(key_dir) if '.part-' not in name]
+        except OSError:
+            return(None, None)
+        if not names:
+            return(None, None)
+        paths = [os.path.join(key_dir, name) for name in names]
+        path = max(paths, key=os.path.getmtime)
+        self._touch(path)
+        etag = os.path.splitext(os.path.basename(path))[0]
+        return(path, f'"{etag}"')
+
+    def _store(self, bucket_name, key, etag, write):
+        """
+        Write a new entry through write(tmp_path), then drop older
+        copies of the same key and evict down to max_bytes
+        """
+        path = self._path(bucket_name, key, etag)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.part-{uuid.uuid4().hex}'
+        try:
+            write(tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self._note(path, os.path.getsize(path))
+        key_dir = os.path.dirname(path)
+        for name in os.listdir(key_dir):
+            old_path = os.path.join(key_dir, name)
+            if old_path != path and '.part-' not in name:
+                self._remove(old_path)
+        self.evict(keep=path)
+        return(path)
+
+    def put_bytes(self, bucket_name, key, etag, data):
+        def write(tmp_path):
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+        return(self._store(bucket_name, key, etag, write))
+
+    def put_bytes_later(self, bucket_name, key, etag, data):
+        """
+        put_bytes in a background thread, so the caller does no disk
+        I/O.  data (bytes or a buffer) must not change until written.
+        """
+        def put():
+            try:
+                self.put_bytes(bucket_name, key, etag, data)
+            except OSError as exc:
+                self.logger.warning(f'Could not cache {bucket_name}/{key} due to {exc}')
+        return(_WRITER.submit(put))
+
+    def get_file(self, bucket_name, key, etag=None):
+        """
+        Local path of bucket_name/key, downloaded only if this ETag is
+        not cached yet.  The ETag is looked up with a HEAD request if
+        not given, so pass it whenever the caller has it.
+        """
+        if etag is None:
+            etag = get_s3_client().head_object(Bucket=bucket_name, Key=key)['ETag']
+        path = self.lookup(bucket_name, key, etag)
+        if path:
+            self.logger.error(f'In cache.py: cache hit for {bucket_name}/{key}')
+            return(path)
+        s3_client = get_s3_client()
+        self.logger.error(f'In cache.py: downloading {bucket_name}/{key}')
+        return(self._store(bucket_name, key, etag, lambda tmp_path: s3_client.download_file(
+            bucket_name, key, tmp_path, Config=TRANSFER_CONFIG)))
+
+    def get_bytes(self, bucket_name, key, etag=None):
+        with open(self.get_file(bucket_name, key, etag), 'rb') as f:
+            return(f.read())
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        with self._lock:
+            self._entries().pop(path, None)
+
+    def evict(self, keep=None):
+        """
+        Delete least recently used files until the cache is within
+        max_bytes.  keep is never deleted.
+        """
+        with self._lock:
+            entries = sorted((mtime, size, path)
+                             for path, (size, mtime) in self._entries().items())
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                if path == keep:
+                    continue
+                self.logger.error(f'In cache.py: evicting {path}')
+                self._remove(path)
+                total -= size
+
+
+_CACHE = None
+_CACHE_LOCK = threading.Lock()
+
+
+def get_local_cache():
+    """
+    The LocalCache shared by the whole process
+    """
+    global _CACHE
+    with _CACHE_LOCK:
+        if _CACHE is None:
+            _CACHE = LocalCache()
+        return(_CACHE)
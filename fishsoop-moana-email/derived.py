@@ -0,0 +1,133 @@
+import os
+import json
+import hashlib
+import logging
+import functools
+import numpy as np
+from botocore.exceptions import ClientError
+from ops_mangopare.aws import get_s3_client, split_s3_path
+from ops_mangopare.artifacts import Artifact
+from ops_mangopare.summary import DeploymentSummary
+
+# Modules whose code decides what the csv, plot and summary look like
+CODE_FILES = ['readers.py', 'plot.py', 'plotdata.py', 'summary.py', 'basemap.py']
+
+
+@functools.lru_cache(maxsize=1)
+def code_version():
+    """
+    Hash of CODE_FILES, so a code change never serves artifacts made by
+    the old code
+    """
+    sha = hashlib.sha1()
+    here = os.path.dirname(os.path.realpath(__file__))
+    for name in CODE_FILES:
+        with open(os.path.join(here, name), 'rb') as f:
+            sha.update(f.read())
+    return(sha.hexdigest()[:12])
+
+
+def _jsonable(value):
+    if isinstance(value, bytes):
+        return(value.decode('utf-8', 'replace'))
+    if isinstance(value, np.ndarray):
+        return(value.tolist())
+    if isinstance(value, np.generic):
+        return(value.item())
+    return(value)
+
+
+class DerivedStore(object):
+    """
+    Content-addressed store of everything derived from a QC'd netCDF
+    file: the csv, the plot, the file's global attributes and its
+    summary.DeploymentSummary.  Entries are keyed by a hash of the input
+    object (bucket, key and ETag), the parameters that change the output
+    (qc_keep, vmin/vmax, lon_offset, cmap, ...) and the code version, so
+    reprocessing an unchanged file with the same settings gets the
+    stored artifacts back without decoding or rendering anything.
+    Each entry is a single <prefix><hash>/manifest.json.  The artifacts
+    themselves are not copied: the manifest points at the bucket and
+    key they were archived to, with a sha256 of their contents, so an
+    archive that has since been overwritten is a miss, not a wrong
+    attachment.
+    Input:
+        prefix: s3:// path under which entries are stored
+    """
+
+    manifest_name = 'manifest.json'
+
+    def __init__(self,
+                 prefix='s3://fishsoop-email/derived/',
+                 logger=logging):
+        self.bucket_name, self.prefix = split_s3_path(prefix.rstrip('/') + '/')
+        self.logger = logger
+        self.s3_client = get_s3_client()
+
+    def digest(self, bucket_name, key, etag, params):
+        """
+        Hash identifying the output of params applied to this version
+        of bucket_name/key
+        """
+        blob = json.dumps({'input': f'{bucket_name}/{key}', 'etag': etag.strip('"'),
+                           'params': params, 'code': code_version()},
+                          sort_keys=True, default=str)
+        return(hashlib.sha256(blob.encode('utf-8')).hexdigest())
+
+    def _key(self, digest, name):
+        return(f'{self.prefix}{digest}/{name}')
+
+    def load(self, digest):
+        """
+        The stored entry for digest, or None.  Returns a dict with
+        attrs, summary and artifacts ({role: artifacts.Artifact}, e.g.
+        'csv' and 'plot'), read back from where they were archived;
+        they are not uploaded again.
+        """
+        try:
+            response = self.s3_client.get_object(
+                Bucket=self.bucket_name, Key=self._key(digest, self.manifest_name))
+        except ClientError as exc:
+            if exc.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                return(None)
+            raise exc
+        manifest = json.loads(response['Body'].read())
+        artifacts = {}
+        for role, entry in manifest['artifacts'].items():
+            try:
+                body = self.s3_client.get_object(
+                    Bucket=entry['bucket_name'], Key=entry['key'])['Body'].read()
+            except ClientError as exc:
+                if exc.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                    return(None)
+                raise exc
+            if hashlib.sha256(body).hexdigest() != entry.get('sha256'):
+                self.logger.error(f'In derived.py: {entry["key"]} changed since {digest}')
+                return(None)
+            artifacts[role] = Artifact(entry['name'], body, entry['content_type'],
+                                       bucket_name=entry['bucket_name'], key=entry['key'],
+                                       logger=self.logger)
+        self.logger.error(f'In derived.py: loaded {digest}')
+        return({'attrs': manifest['attrs'],
+                'summary': DeploymentSummary.from_dict(manifest['summary']),
+                'artifacts': artifacts})
+
+    def save(self, digest, attrs, summary, artifacts):
+        """
+        Store attrs, the summary and artifacts ({role: Artifact}) under
+        digest.  The artifacts must have been archived already.
+        """
+        manifest = {'attrs': {name: _jsonable(value) for name, value in attrs.items()},
+                    'summary': summary.to_dict(),
+                    'artifacts': {role: {'name': artifact.name,
+                                         'content_type': artifact.content_type,
+                                         'bucket_name': artifact.bucket_name,
+                                         'key': artifact.key,
+                                         'sha256': hashlib.sha256(artifact.data).hexdigest()}
+                                  for role, artifact in artifacts.items()},
+                    'code_version': code_version()}
+        self.s3_client.put_object(Bucket=self.bucket_name,
+                                  Key=self._key(digest, self.manifest_name),
+                                  Body=json.dumps(manifest, default=str).encode('utf-8'),
+                                  ContentType='application/json')
+        self.logger.error(f'In derived.py: saved {digest}')
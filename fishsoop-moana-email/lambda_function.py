@@ -1,27 +1,43 @@
+import json
 import logging
 import os
-import boto3
+from urllib.parse import unquote_plus
 from wrapper import SendDataWrapper  # Import the SendDataWrapper class from the main code file
+from status import StatusLog
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger()
 logger.info("Starting lambda")
 
+def get_file_paths(event):
+    """
+    Build the list of s3:// paths from every record in the event.
+    Handles S3 notifications delivered directly or wrapped in SQS
+    messages, and drops repeated keys.
+    """
+    file_paths = []
+    for record in event.get('Records', []):
+        if 'body' in record:
+            # SQS message whose body is itself an S3 event
+            file_paths.extend(get_file_paths(json.loads(record['body'])))
+        elif 's3' in record:
+            bucket_name = record['s3']['bucket']['name']
+            object_key = unquote_plus(record['s3']['object']['key'])
+            file_paths.append(f"s3://{bucket_name}/{object_key}")
+    return list(dict.fromkeys(file_paths))
+
 def lambda_handler(event, context):
     try:
         logger.error("Trying lambda_handler")
-        # Get the bucket and key information from the event
-        s3_event = event['Records'][0]['s3']
-        bucket_name = s3_event['bucket']['name']
-        object_key = s3_event['object']['key']
-
-        # Construct the full S3 object path
-        qc_file_path = f"s3://{bucket_name}/{object_key}"
-        logger.error(f"File is {qc_file_path}")
+        # Get the S3 object paths of all records in the event
+        qc_file_paths = get_file_paths(event)
+        logger.error(f"Files are {qc_file_paths}")
 
         # Instantiate the SendDataWrapper class and call its run() method
-        senddata_wrapper = SendDataWrapper(filelist=[qc_file_path], event=event)
+        senddata_wrapper = SendDataWrapper(
+            filelist=qc_file_paths, event=event,
+            max_workers=int(os.environ.get('MAX_WORKERS', 4)))
         logger.error(f"Started SendDataWrapper in lambda_handler")
         success_files = senddata_wrapper.run()
         logger.error(f"Ran senddata_wrapper in lambda_handler")
@@ -30,3 +46,15 @@ def lambda_handler(event, context):
     except Exception as e:
         logger.error("Error occurred: %s", e)
         raise e
+
+def compact_handler(event, context):
+    """
+    Scheduled entry point that merges the emails sent status log
+    segments of finished hours
+    """
+    try:
+        n_hours = StatusLog(logger=logger).compact()
+        logger.error("Compacted status log segments for %s hours", n_hours)
+    except Exception as e:
+        logger.error("Error occurred: %s", e)
+        raise e
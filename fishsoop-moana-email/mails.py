@@ -1,17 +1,21 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
 import os
-import boto3
 import datetime
 import logging
 import numpy as np
 import pandas as pd
-import smtplib
 import tempfile
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.application import MIMEApplication
 from email.utils import parseaddr
+from ops_mangopare.aws import get_s3_client, split_s3_path, TRANSFER_CONFIG
+from ops_mangopare.status import SentLedger, StatusLog
+from ops_mangopare.smtppool import SMTPPool
+from ops_mangopare.artifacts import Artifact
+from ops_mangopare.summary import DeploymentSummary
+from ops_mangopare.cache import get_local_cache
 
 #from ops_core.mailer import MandrillMailer, parse_address
 
@@ -114,6 +118,8 @@ class MangopareMailer(object):
         from_email: email address that the email will be sent from
         bcc: list of bcc email addresses
         additional attachments: list of any other files to attach
+        Plots and attachments are artifacts.Artifact objects, attached
+        straight from memory, or names of files in fishsoop-email/<serial>/.
         recipients: list of email addresses to send email to.  If
         this is False, it will use the default_email.
         reply_to: email address to use if recipient replies to email
@@ -128,8 +134,26 @@ class MangopareMailer(object):
         in the email.  Not sure it works right now.
         default_email: If recipients is False, the email will be
         sent to this address.
+        ledger_prefix: s3:// location of the sent ledger (see
+        status.SentLedger).  Once the status file history has been
+        imported into it, duplicates are checked against the ledger
+        instead of reading the whole status file.
+        status_log_prefix: s3:// location of the append-only status log
+        (see status.StatusLog).  If set, sends are recorded there, one
+        segment per email, instead of being appended to status_file,
+        which is then only read as history.
+        status_log: status.StatusLog to use instead of making one from
+        status_log_prefix, normally shared by all emails of a batch so
+        the log is read once.
+        summary: summary.DeploymentSummary of ds, computed here if None
+        attrs: global attributes of the file, ds.attrs if None.  With
+        both attrs and summary given, ds is not used and can be None.
+        smtp_pool: smtppool.SMTPPool to send through, normally shared by
+        all emails of a batch.  If None, a connection is opened for this
+        email only.
     Output:
-        Email is send and status file is updated.  Nothing is returned.
+        Email is send and status file is updated.  run() returns True if
+        the email was sent.
     """
 
     def __init__(self, ds, plots,
@@ -142,10 +166,20 @@ class MangopareMailer(object):
                  create_status_file=False,
                  logo='fsoop_logo.png',
                  default_email=['fishsoop@unsw.edu.au'],
+                 ledger_prefix='s3://fishsoop-email/sent_ledger/',
+                 status_log_prefix='s3://fishsoop-email/status_log/',
+                 status_log=None,
+                 smtp_pool=None,
+                 summary=None,
+                 attrs=None,
                  logger=logging):
         self.ds = ds
-        self.plots = plots
-        self.attachments = additional_attachments
+        self.summary = summary
+        self.attrs = attrs if attrs is not None else ds.attrs
+        self.artifacts = {a.name: a for a in plots + additional_attachments
+                          if isinstance(a, Artifact)}
+        self.plots = [str(i) if i else i for i in plots]
+        self.attachments = [str(i) if i else i for i in additional_attachments]
         self.from_email = from_email
         self.recipients = recipients
         self.bcc = bcc
@@ -155,6 +189,12 @@ class MangopareMailer(object):
         self.create_status_file = create_status_file
         self.default_email = default_email
         self.logger = logger
+        self.smtp_pool = smtp_pool
+        self.ledger = SentLedger(prefix=ledger_prefix, logger=logger) if ledger_prefix else None
+        if status_log is None and status_log_prefix:
+            status_log = StatusLog(prefix=status_log_prefix, legacy_file=status_file,
+                                   logger=logger)
+        self.status_log = status_log
         #self.mailer = MandrillMailer()
         self.vessel_attrs = ['vessel_name','vessel_id','moana_serial_number','programme_name']
         self.default_email_text = {'sensor_name': 'Moana',
@@ -175,7 +215,7 @@ class MangopareMailer(object):
         sensor_name = self.default_email_text['sensor_name']
         title_name = self.default_email_text['title_name']
         try:
-            if self.ds.attrs['programme_name'] == 'Fish-Soop':
+            if self.attrs['programme_name'] == 'Fish-Soop':
                 data_statement = '''Temperature sensor and deck unit funded by the Integrated Marine Observing System (IMOS) 
                 as part of Fisheries Research and Development Corporation (FRDC) project number 2022-07. 
                 Data collected as part of FishSOOP: Oceanographic data collection on commercial fishing vessels; a partnership 
@@ -199,30 +239,27 @@ class MangopareMailer(object):
         }
         # vessel info
         for attr_name in self.vessel_attrs:
-            if isinstance(self.ds.attrs[attr_name], (str, int)) and self.ds.attrs[attr_name] != 'NA':
-                context[attr_name] = self.ds.attrs[attr_name]
+            if isinstance(self.attrs[attr_name], (str, int)) and self.attrs[attr_name] != 'NA':
+                context[attr_name] = self.attrs[attr_name]
             else:
                 context[attr_name] = f'Unknown {attr_name}'
         #if not self.recipients:
         #    self.recipients = self.ds['Vessel Email'].split(",")
-        context['time_min'] = str(
-            np.min(self.ds.DATETIME.values).astype('datetime64[s]'))
-        context['time_max'] = str(
-            np.max(self.ds.DATETIME.values).astype('datetime64[s]'))
+        if self.summary is None:
+            self.summary = DeploymentSummary(self.ds, logger=self.logger)
+        summary = self.summary
+        context['time_min'] = str(summary.time_min.astype('datetime64[s]'))
+        context['time_max'] = str(summary.time_max.astype('datetime64[s]'))
         # for testing only:
-        context['vessel_email'] = self.ds.attrs['vessel_email']
-        temp = self.ds.TEMPERATURE.values
-        depth = self.ds.DEPTH.values
-        i_tmin = np.nanargmin(temp)
-        i_tmax = np.nanargmax(temp)
-        context['temp_min'] = f'{temp[i_tmin]:.2f}'
-        context['temp_max'] = f'{temp[i_tmax]:.2f}'
-        context['temp_avg'] = f'{np.nanmean(temp):.2f}'
-        context['depth_tmin'] = f'{depth[i_tmin]:.1f}'
-        context['depth_tmax'] = f'{depth[i_tmax]:.1f}'
-        context['depth_avg'] = f'{np.nanmean(depth):.1f}'
-        context['depth_min'] = f'{np.nanmin(depth):.1f}'
-        context['depth_max'] = f'{np.nanmax(depth):.1f}'
+        context['vessel_email'] = self.attrs['vessel_email']
+        context['temp_min'] = f'{summary.temp_min:.2f}'
+        context['temp_max'] = f'{summary.temp_max:.2f}'
+        context['temp_avg'] = f'{summary.temp_mean:.2f}'
+        context['depth_tmin'] = f'{summary.depth_at_temp_min:.1f}'
+        context['depth_tmax'] = f'{summary.depth_at_temp_max:.1f}'
+        context['depth_avg'] = f'{summary.depth_mean:.1f}'
+        context['depth_min'] = f'{summary.depth_min:.1f}'
+        context['depth_max'] = f'{summary.depth_max:.1f}'
         context['email_error'] = 'None'
         return context
 
@@ -257,12 +294,21 @@ class MangopareMailer(object):
 
     def _record_success(self):
         """
-        Append email info to the status_file csv, or create csv if it doesn't exist yet
+        Add email info to the status log, or append it to the status_file csv
+        (creating the csv if it doesn't exist yet) when there is no status log
         """
         self.logger.error('In mails.py: _record_success')
-        df = pd.DataFrame({'Datetime': datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S UTC'), 'Recipients': self._l_to_s(self.recipients), 'Attachments': self._l_to_s(self.attachments),
-                           'Plots': self._l_to_s(self.plots), 'BCC': self._l_to_s(self.bcc), 'From': self._l_to_s([self.from_email]), 'Replyto': self._l_to_s([self.reply_to])}, index=[0])
-        df.to_csv(self.status_file, mode='a', header=False)
+        row = {'Datetime': datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S UTC'), 'Recipients': self._l_to_s(self.recipients), 'Attachments': self._l_to_s(self.attachments),
+               'Plots': self._l_to_s(self.plots), 'BCC': self._l_to_s(self.bcc), 'From': self._l_to_s([self.from_email]), 'Replyto': self._l_to_s([self.reply_to])}
+        if self.status_log:
+            self.status_log.append(row)
+        else:
+            df = pd.DataFrame(row, index=[0])
+            df.to_csv(self.status_file, mode='a', header=False)
+        if self.ledger:
+            for name in self.attachments + self.plots:
+                if name:
+                    self.ledger.mark_sent(name, {'recipients': self._l_to_s(self.recipients)})
 
     def _create_status_file(self):
         """
@@ -270,10 +316,8 @@ class MangopareMailer(object):
         """
         self.logger.error('In mails.py: _create_status_file')
         
-        bucket_name, object_key = self.status_file.split('://')[1].split('/', 1)
-        
-        # Initialize S3 client
-        s3_client = boto3.client('s3')
+        bucket_name, object_key = split_s3_path(self.status_file)
+        s3_client = get_s3_client()
         
         # Check if the file already exists in the bucket
         try:
@@ -312,37 +356,50 @@ class MangopareMailer(object):
         self.logger.error(f'In mails.py, get_email_param, self.plots is {self.plots} and all_attach is {self.all_attach}')
         self.all_attach = [i for i in self.all_attach if i]
 
+    def _read_status_file(self):
+        """
+        Download the status_file csv and read it with pandas
+        """
+        # Extract bucket name and object key from the S3 URL
+        bucket_name, object_key = split_s3_path(self.status_file)
+        
+        # Get the filename from the object key
+        status_filename = os.path.basename(object_key)
+        
+        # Create a temporary directory
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            local_csv_path = os.path.join(tmp_dir, status_filename)
+            
+            # Download the CSV file from S3 to the local temporary file
+            get_s3_client().download_file(bucket_name, object_key, local_csv_path,
+                                          Config=TRANSFER_CONFIG)
+            
+            # Read the local CSV file using pandas
+            return(pd.read_csv(local_csv_path))
+
     def _check_if_duplicates(self):
         """
         Check if status file contains attachments and plots that are to be sent to avoid emailing duplicates
         """
         self.logger.error('In mails.py: _check_if_duplicates')
+        if self.ledger and self.ledger.is_ready():
+            return(self.ledger.any_sent(self.attachments + self.plots))
         try:
-            # Extract bucket name and object key from the S3 URL
-            bucket_name, object_key = self.status_file.split('://')[1].split('/', 1)
-            
-            # Get the filename from the object key
-            status_filename = os.path.basename(object_key)
+            if self.status_log:
+                sent = self.status_log.sent_names()
+            else:
+                df = self._read_status_file()
+                sent = {'Attachments': set(df['Attachments'].to_list()),
+                        'Plots': set(df['Plots'].to_list())}
             
-            # Create a temporary directory
-            with tempfile.TemporaryDirectory() as tmp_dir:
-                local_csv_path = os.path.join(tmp_dir, status_filename)
-                
-                # Download the CSV file from S3 to the local temporary file
-                s3_client = boto3.client('s3')
-                s3_client.download_file(bucket_name, object_key, local_csv_path)
-                
-                # Read the local CSV file using pandas
-                df = pd.read_csv(local_csv_path)
-                
-                duplicate_attachments = [
-                    i for i in self.attachments if i in df['Attachments'].to_list()]
-                duplicate_plots = [
-                    i for i in self.plots if i in df['Plots'].to_list()]
-                if duplicate_attachments or duplicate_plots:
-                    return(True)
-                else:
-                    return(False)
+            duplicate_attachments = [
+                i for i in self.attachments if i in sent['Attachments']]
+            duplicate_plots = [
+                i for i in self.plots if i in sent['Plots']]
+            if duplicate_attachments or duplicate_plots:
+                return(True)
+            else:
+                return(False)
         except Exception as exc:
             self.logger.error(
                 f'Could not read status file {self.status_file} due to {exc}')
@@ -360,11 +417,6 @@ class MangopareMailer(object):
         """
         self.logger.error('In mails.py: _send_email_SMTP')
 
-        smtp_server = 'SERVER'
-        smtp_port = SMTP_PORT
-        smtp_username = 'username'
-        smtp_password = 'password'
-
         msg = MIMEMultipart("alternative")
         msg['From'] = self.from_email
         msg['To'] = ', '.join(to)
@@ -379,55 +431,63 @@ class MangopareMailer(object):
         bucket_name = 'fishsoop-email'
         for attachment in attachments:
             
+            if attachment in self.artifacts:
+                # Already in memory, no need to go through S3
+                part = MIMEApplication(self.artifacts[attachment].data, Name=attachment)
+                part['Content-Disposition'] = f'attachment; filename="{attachment}"'
+                msg.attach(part)
+                continue
+
             folder_name = attachment.split('_')[1]  # Extract the 4 digits following MOANA_
             object_key = f'{folder_name}/{attachment}'  # Construct the object key
-            local_file_path = f'/tmp/{attachment}'
             
-            # Download the file from S3
-            s3 = boto3.client('s3')
+            # Download the file from S3, through the size-capped local cache
             self.logger.error(f'Loading into Lambda file: {bucket_name}/{object_key}')
-            s3.download_file(bucket_name, object_key, local_file_path)
-            with open(local_file_path, 'rb') as file:
-                part = MIMEApplication(file.read(), Name=attachment)
+            part = MIMEApplication(get_local_cache().get_bytes(bucket_name, object_key),
+                                   Name=attachment)
             part['Content-Disposition'] = f'attachment; filename="{attachment}"'
             msg.attach(part)
 
         try:
-            with smtplib.SMTP(smtp_server, smtp_port) as server:
-                server.starttls()
-                server.login(smtp_username, smtp_password)
-                #email_body = f"From: {self.from_email}\nTo: {', '.join(to)}\nSubject: {subject}\n\n{body_html}"
-                server.sendmail(self.from_email, to, msg.as_string())
-
-                return True
+            if self.smtp_pool:
+                self.smtp_pool.sendmail(self.from_email, to, msg.as_string())
+            else:
+                with SMTPPool(max_connections=1, logger=self.logger) as pool:
+                    pool.sendmail(self.from_email, to, msg.as_string())
+            return True
         except Exception as e:
             self.logger.error(f'Error sending email: {e}')
             return False
 
     def run(self):
         """
-        Send email with data, check if email sent, record sent email
+        Send email with data, check if email sent, record sent email.
+        Returns True if the email was sent, False otherwise.
         """
         self.logger.error('In mails.py: run')
+        sent = False
         try:
             self.logger.error(f'The create_status_file is set to: {self.create_status_file}')
             if self.create_status_file:
                 self.logger.error('Lets go create that file')
                 self._create_status_file()
             self._get_email_parameters()
+            duplicates = False
             if self.status_file:
                 duplicates = self._check_if_duplicates()
             self.logger.error('In mails.py: back in run after _check_if_duplicates')
             if (not duplicates or not self.status_file) and (len(self.all_attach) > 0):
                 self.logger.error(
                     f'Emailing {self.recipients} Moana data...')
-                self._send_email_SMTP(to=self.recipients, bcc=self.bcc,
-                                    subject=self.subject,
-                                    body_html=self.html,
-                                    body_text=self.text,
-                                    attachments=self.all_attach,
-                                    important=False)
-                
+                sent = self._send_email_SMTP(to=self.recipients, bcc=self.bcc,
+                                             subject=self.subject,
+                                             body_html=self.html,
+                                             body_text=self.text,
+                                             attachments=self.all_attach,
+                                             important=False)
+                if not sent:
+                    return(False)
+
                 good_email = self.has_been_alerted()
                 self.logger.error('Email sent.')
                 
@@ -438,9 +498,10 @@ class MangopareMailer(object):
                     self._record_success()
                     
             else:
-                raw_file = self.ds.attrs['raw_data_filename']
+                raw_file = self.attrs['raw_data_filename']
                 self.logger.error(
                     f'Email not sent because duplicate found in {self.status_file} for {raw_file} or no attachments found.')
         except Exception as exc:
-            filename = self.ds.attrs['raw_data_filename']
+            filename = self.attrs['raw_data_filename']
             self.logger.error(f'Email not sent for {filename} due to {exc}')
+        return(sent)
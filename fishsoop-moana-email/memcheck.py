@@ -0,0 +1,259 @@
+"""
+Memory check for the read and plot path in a warm container.
+
+Drives SendDataWrapper's read and plot stages and its _finish over many
+synthetic deployments, some of which fail (corrupt files, files missing
+variables), all in one process as a warm Lambda would.  It then checks
+that resident memory stays flat after a warm-up, and that no figures,
+file descriptors or temporary files are left behind.  S3 is replaced by
+LocalS3Client, which serves the files from a local directory and
+discards uploads, and the local cache is pointed at that directory too;
+nothing is emailed.  test_memcheck.py runs a short check as a test.
+
+Usage:
+    python memcheck.py
+    python memcheck.py --files 300 --fail-every 3 --max-growth-mb 20
+
+Exits with status 1 if RSS grows by more than --max-growth-mb between
+the end of the warm-up and the end of the run, or figures, file
+descriptors or temporary files leak, so it can be run as a regression
+check.
+"""
+import io
+import os
+import gc
+import sys
+import shutil
+import hashlib
+import argparse
+import logging
+import tempfile
+import resource
+import numpy as np
+from testutils import add_package_path
+
+KINDS = ['corrupt', 'missing_temperature', 'no_good_data']
+
+
+class LocalS3Client(object):
+    """
+    The parts of the S3 client the wrapper uses, over the files in
+    data_dir (any bucket).  Uploads are read and dropped.
+    """
+
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        self.uploads = 0
+
+    def _path(self, key):
+        return(os.path.join(self.data_dir, key.lstrip('/')))
+
+    def _missing(self, key):
+        from botocore.exceptions import ClientError
+        return(ClientError({'Error': {'Code': 'NoSuchKey', 'Message': key}}, 'GetObject'))
+
+    def head_object(self, Bucket, Key, **kwargs):
+        path = self._path(Key)
+        if not os.path.exists(path):
+            raise self._missing(Key)
+        with open(path, 'rb') as f:
+            etag = hashlib.md5(f.read()).hexdigest()
+        return({'ETag': f'"{etag}"', 'ContentLength': os.path.getsize(path)})
+
+    def get_object(self, Bucket, Key, Range=None, **kwargs):
+        head = self.head_object(Bucket, Key)
+        with open(self._path(Key), 'rb') as f:
+            if Range:
+                start, end = [int(i) for i in Range.split('=')[1].split('-')]
+                f.seek(start)
+                body = f.read(end - start + 1)
+            else:
+                body = f.read()
+        return(dict(head, Body=io.BytesIO(body)))
+
+    def download_fileobj(self, Bucket, Key, Fileobj, **kwargs):
+        self.head_object(Bucket, Key)
+        with open(self._path(Key), 'rb') as f:
+            shutil.copyfileobj(f, Fileobj)
+
+    def download_file(self, Bucket, Key, Filename, **kwargs):
+        with open(Filename, 'wb') as f:
+            self.download_fileobj(Bucket, Key, f)
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, **kwargs):
+        while Fileobj.read(1024 * 1024):
+            pass
+        self.uploads += 1
+
+    def put_object(self, **kwargs):
+        self.uploads += 1
+
+
+def _rss_mb():
+    """
+    Current resident set size, or the peak where /proc is not available
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return(pages * os.sysconf('SC_PAGE_SIZE') / 2**20)
+    except (OSError, ValueError):
+        return(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+
+
+def _open_fds():
+    try:
+        return(len(os.listdir('/proc/self/fd')))
+    except OSError:
+        return(0)
+
+
+def _make_file(path, n, kind=None, seed=0):
+    """
+    Write a synthetic QC'd deployment of n samples.  kind makes it one
+    of the failing cases in KINDS.
+    """
+    import xarray as xr
+    if kind == 'corrupt':
+        with open(path, 'wb') as f:
+            f.write(b'CDF\x01' + os.urandom(1024))
+        return
+    rng = np.random.default_rng(seed)
+    times = np.datetime64('2024-01-01T00:00:00') + np.arange(n) * np.timedelta64(30, 's')
+    depth = 200 * np.abs(np.sin(np.linspace(0, 6, n))) + rng.random(n)
+    ds = xr.Dataset(
+        {'TEMPERATURE': ('DATETIME', 18 - depth / 40 + rng.random(n)),
+         'DEPTH': ('DATETIME', depth),
+         'LATITUDE': ('DATETIME', -41 + np.cumsum(rng.normal(0, 1e-3, n))),
+         'LONGITUDE': ('DATETIME', 174 + np.cumsum(rng.normal(0, 1e-3, n))),
+         'QC_FLAG': ('DATETIME', np.full(n, 4 if kind == 'no_good_data' else 1, dtype=np.int8)),
+         'PHASE': ('DATETIME', np.where(depth > 100, 'D', 'A'))},
+        coords={'DATETIME': times},
+        attrs={'moana_serial_number': '1234', 'programme_name': 'Fish-Soop',
+               'email_frequency': 'nrt', 'email_status': 'on'})
+    if kind == 'missing_temperature':
+        ds = ds.drop_vars('TEMPERATURE')
+    ds.to_netcdf(path)
+
+
+def _process(wrapper, filename):
+    """
+    One file through the wrapper's read and plot stages and _finish,
+    the way its stage workers run them
+    """
+    item = {'filename': filename}
+    try:
+        for func in (wrapper._read_stage, wrapper._plot_stage):
+            item = func(item)
+    except Exception:
+        wrapper._finish(item, ok=False)
+        return(False, item)
+    wrapper._finish(item, ok=True)
+    return(not item['skip'], item)
+
+
+def check(n_files=200, n_samples=5000, fail_every=3, warmup=0.25,
+          spool_bytes=64 * 1024, logger=logging):
+    """
+    Process n_files deployments and return what was left behind.
+    spool_bytes replaces readers.CSV_SPOOL_BYTES, small enough that the
+    csv files go to disk and their release is checked too.
+    """
+    add_package_path()
+    from ops_mangopare import aws, cache, plot, readers
+    from ops_mangopare.wrapper import SendDataWrapper
+    from ops_mangopare.readers import MangopareNetCDFReader
+
+    work_dir = tempfile.mkdtemp(prefix='memcheck_')
+    data_dir = os.path.join(work_dir, 'data')
+    tmp_dir = os.path.join(work_dir, 'tmp')
+    os.makedirs(data_dir)
+    os.makedirs(tmp_dir)
+    saved = (aws._client, cache._CACHE, readers.CSV_SPOOL_BYTES, tempfile.tempdir)
+    aws._client = LocalS3Client(data_dir)
+    readers.CSV_SPOOL_BYTES = spool_bytes
+    cache._CACHE = cache.LocalCache(cache_dir=os.path.join(work_dir, 'cache'), logger=logger)
+    # every temporary file made while checking lands here
+    tempfile.tempdir = tmp_dir
+    try:
+        filenames = []
+        for i in range(n_files):
+            kind = KINDS[(i // fail_every) % len(KINDS)] if fail_every and i % fail_every == 0 else None
+            name = f'MOANA_1234_{i}_{kind or "good"}.nc'
+            _make_file(os.path.join(data_dir, name), n_samples, kind, seed=i)
+            filenames.append(f's3://local/{name}')
+
+        wrapper = SendDataWrapper(filelist=filenames, ledger_prefix=None, derived_prefix=None,
+                                  email_plot=True, email_raw_data=True, logger=logger)
+        wrapper.datareader = MangopareNetCDFReader
+        n_warmup = min(max(1, int(n_files * warmup)), n_files - 1)
+        results = {'ok': 0, 'failed': 0, 'unreleased': 0}
+        for i, filename in enumerate(filenames):
+            if i == n_warmup:
+                gc.collect()
+                rss_start, fds_start = _rss_mb(), _open_fds()
+            ok, item = _process(wrapper, filename)
+            results['ok' if ok else 'failed'] += 1
+            # _finish must have taken the reader and dataset off the item
+            if 'reader' in item or 'ds' in item:
+                results['unreleased'] += 1
+            del item
+        gc.collect()
+        results['rss_start_mb'] = rss_start
+        results['rss_end_mb'] = _rss_mb()
+        results['open_fds'] = _open_fds() - fds_start
+        results['open_figures'] = len(plot.plt.get_fignums()) if plot.plt else 0
+        results['temp_files'] = sorted(os.listdir(tmp_dir))
+        results['uploads'] = aws._client.uploads
+    finally:
+        aws._client, cache._CACHE, readers.CSV_SPOOL_BYTES, tempfile.tempdir = saved
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return(results)
+
+
+def failures(results, max_growth_mb=20):
+    """
+    What the results of check() show leaking, as messages
+    """
+    growth = results['rss_end_mb'] - results['rss_start_mb']
+    out = []
+    if growth > max_growth_mb:
+        out.append(f'RSS grew by {growth:.1f} MB')
+    if results['open_figures']:
+        out.append(f"{results['open_figures']} figures left open")
+    if results['open_fds'] > 0:
+        out.append(f"{results['open_fds']} file descriptors left open")
+    if results['unreleased']:
+        out.append(f"{results['unreleased']} readers or datasets not released")
+    if results['temp_files']:
+        out.append(f"{len(results['temp_files'])} temporary files left behind")
+    return(out)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--files', type=int, default=200, help='deployments to process')
+    parser.add_argument('--samples', type=int, default=5000, help='samples per deployment')
+    parser.add_argument('--fail-every', type=int, default=3,
+                        help='every n-th file is a failing one')
+    parser.add_argument('--max-growth-mb', type=float, default=20,
+                        help='allowed RSS growth after the warm-up')
+    args = parser.parse_args(argv)
+    logger = logging.getLogger('memcheck')
+    logger.setLevel(logging.CRITICAL)
+
+    results = check(args.files, args.samples, args.fail_every, logger=logger)
+    growth = results['rss_end_mb'] - results['rss_start_mb']
+    print(f"processed {results['ok']} ok, {results['failed']} failed")
+    print(f"RSS {results['rss_start_mb']:.1f} MB after warm-up, "
+          f"{results['rss_end_mb']:.1f} MB at the end ({growth:+.1f} MB)")
+    print(f"open figures {results['open_figures']}, new file descriptors {results['open_fds']}, "
+          f"temporary files {len(results['temp_files'])}")
+    found = failures(results, args.max_growth_mb)
+    for failure in found:
+        print(f'FAILED: {failure}')
+    return(1 if found else 0)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,28 +1,89 @@
 import os
+import inspect
 import logging
 import numpy as np
-import cartopy
-import boto3
 import re
 import io
-import zipfile
-import urllib.request
-import cartopy.io.shapereader as shpreader
-import cartopy.mpl as cmpl
-from cartopy.mpl.gridliner import LONGITUDE_FORMATTER, LATITUDE_FORMATTER
-import cartopy.feature as cfeature
-import cartopy.crs as ccrs
-import matplotlib.pyplot as plt
-import matplotlib as mpl
-import matplotlib.dates as mdates
-import matplotlib.ticker as mticker
-from matplotlib.transforms import blended_transform_factory
-from matplotlib import gridspec
-from PIL import Image
-import cmocean as cmo
-from mpl_toolkits.axes_grid1.inset_locator import inset_axes
-from pandas.plotting import register_matplotlib_converters
-register_matplotlib_converters()
+from ops_mangopare.artifacts import Artifact
+from ops_mangopare.basemap import Basemap
+from ops_mangopare.assets import get_asset_cache
+from ops_mangopare.plotdata import decimate_extremes, bin_mean
+from ops_mangopare.summary import DeploymentSummary
+
+# cartopy, matplotlib and cmocean are a large part of the Lambda cold
+# start, and files that are skipped are never plotted, so they are only
+# imported by _import_plotting when the first plot is made
+cartopy = cmpl = ccrs = None
+plt = mpl = mdates = mticker = gridspec = cmo = None
+LONGITUDE_FORMATTER = LATITUDE_FORMATTER = None
+blended_transform_factory = inset_axes = None
+
+# Figure skeletons kept between files in reuse_figure mode, see
+# PlotMangopare._get_figure
+_FIGURES = {}
+
+# Land/coast tiles for the inset map, one per tile directory
+_BASEMAPS = {}
+
+# PlotMangopare arguments that change the png, see render_params
+RENDER_PARAMS = ['add_map', 'vmin', 'vmax', 'lon_offset', 'cmap', 'max_points',
+                 'render_mode', 'raster_shape', 'map_raster_shape', 'out_dir',
+                 'reuse_figure', 'add_logo']
+
+# The parts of a dataset a plot needs, see plot_inputs
+PLOT_VARIABLES = ['DATETIME', 'DEPTH', 'TEMPERATURE', 'LATITUDE', 'LONGITUDE', 'PHASE']
+
+
+def _import_plotting():
+    """
+    Import the plotting libraries into this module, once per process
+    """
+    global cartopy, cmpl, ccrs, plt, mpl, mdates, mticker, gridspec, cmo
+    global LONGITUDE_FORMATTER, LATITUDE_FORMATTER
+    global blended_transform_factory, inset_axes
+    if plt is not None:
+        return
+    import matplotlib
+    matplotlib.use('Agg')
+    import cartopy as _cartopy
+    import cartopy.mpl as _cmpl
+    import cartopy.mpl.geoaxes
+    import cartopy.crs as _ccrs
+    from cartopy.mpl.gridliner import LONGITUDE_FORMATTER as _lon_fmt, LATITUDE_FORMATTER as _lat_fmt
+    import matplotlib.dates as _mdates
+    import matplotlib.ticker as _mticker
+    from matplotlib.transforms import blended_transform_factory as _blended
+    from matplotlib import gridspec as _gridspec
+    import cmocean as _cmo
+    from mpl_toolkits.axes_grid1.inset_locator import inset_axes as _inset_axes
+    from pandas.plotting import register_matplotlib_converters
+    import matplotlib.pyplot as _plt
+    register_matplotlib_converters()
+    cartopy, cmpl, ccrs = _cartopy, _cmpl, _ccrs
+    LONGITUDE_FORMATTER, LATITUDE_FORMATTER = _lon_fmt, _lat_fmt
+    mpl, mdates, mticker, gridspec, cmo = matplotlib, _mdates, _mticker, _gridspec, _cmo
+    blended_transform_factory, inset_axes = _blended, _inset_axes
+    plt = _plt
+
+def _decode_image(data):
+    return(plt.imread(io.BytesIO(data)))
+
+
+class _PlotFigure(object):
+    """
+    Handles to the parts of a deployment plot that PlotMangopare fills
+    in for each file: fig, ax, dot_c (depth-time scatter), dot_img
+    (depth-time raster), norm (color scale shared by a persistent
+    figure), and axins, map_dot, map_img and gl for the inset map.
+    A persistent (reuse_figure)
+    figure has empty placeholders for dot_c, dot_img, map_dot and
+    map_img that each file's data are swapped into; otherwise they are
+    drawn for the one file the figure is for.  logo_ax holds the logo,
+    once there is one.
+    """
+    persistent = False
+    logo_ax = None
+
 
 class PlotMangopare(object):
     """
@@ -34,6 +95,8 @@ class PlotMangopare(object):
         filename: original data filename, to be printed on plot
         out_dir: directory where plot will be saved
         logo_file: path and filename for logo, if to be included on plot
+        add_logo: draw logo_file on the plot.  Off by default, the emailed
+        plots have never shown it.
         add_map: toggle whether to add a map to plot.  in current format,
         it will look strange if this is set to False
         vmin: minimum temperature value for colorscale (auto calculated
@@ -41,11 +104,42 @@ class PlotMangopare(object):
         vmax: maximum temperature value for colorscale
         lon_offset: use 180 if plotting across 180 meridian (i.e. Pacific)
         cmap: specify matplotlib colormap to use for temperature data
-        feature_dir: allows you to specify a directory to look in for
-        map coast data, otherwises uses the default below.  If neither are
+        (cmocean thermal if None)
+        feature_dir: allows you to specify a local directory to look in for
+        cartopy data, otherwises uses the default below.  If neither are
         available, cartopy looks to it's default online location.
+        basemap_dir: directory with the pre-rasterised land tiles drawn
+        under the inset map (see basemap.py).  If None, the default
+        locations in basemap.py are searched.  Without tiles the map has
+        no land, as before the tiles existed; nothing is ever downloaded
+        while plotting.
+        max_points: point budget for the depth-time scatter and the map.
+        Larger deployments are thinned to the depth and temperature
+        extremes in each pixel column (see plotdata.decimate_extremes),
+        which looks the same but renders much faster.  None plots every
+        point.
+        render_mode: 'scatter' draws every (or max_points) sample.
+        'raster' averages temperature into a fixed grid of cells over
+        time and depth, and over longitude and latitude for the map, and
+        draws each as a single image with the same colormap and color
+        range, so rendering time no longer depends on the number of
+        samples.  For the very largest deployments.
+        raster_shape: (depth rows, time columns) of the depth-time grid
+        map_raster_shape: (latitude rows, longitude columns) of the map grid
+        The figure is closed when run() returns, whether or not the plot
+        worked (except in reuse_figure mode); using PlotMangopare as a
+        context manager does the same for callers that build the plot
+        step by step.
+        reuse_figure: build the figure (axes, colorbar, formatters, inset
+        map, gridlines) once per process and only swap in each file's
+        data, and save it with a fixed layout instead of a tight bbox.
+        Much faster when plotting many files in one process.
+        summary: summary.DeploymentSummary of ds, computed here if None
+        archive: start uploading the png to S3 straight away.  Set to
+        False when the caller archives the artifact itself.
     Outputs:
-        savefile: path and filename of saved plot
+        plot: artifacts.Artifact holding the png, already being
+        archived to S3 in the background
         time_vals: time range (min and max time values) that the plot covers
     """
 
@@ -54,30 +148,64 @@ class PlotMangopare(object):
                  filename,
                  out_dir=None,
                  logo_file=None,
+                 add_logo=False,
                  add_map=True,
                  vmin=False,
                  vmax=False,
                  lon_offset=180,
-                 feature_dir='s3://fishsoop-qc-tools/cartopy_data/shapefiles/gshhs/',
-                 cmap=cmo.cm.thermal,
+                 feature_dir=None,
+                 cmap=None,
+                 reuse_figure=False,
+                 basemap_dir=None,
+                 max_points=None,
+                 render_mode='scatter',
+                 raster_shape=(120, 400),
+                 map_raster_shape=(80, 80),
+                 summary=None,
+                 archive=True,
                  logger=logging):
 
         self.ds = ds
         self.filename = filename
         self.out_dir = out_dir
         self.logo_file = logo_file
+        self.add_logo = add_logo
         self.add_map = add_map
         self.vmin = vmin
         self.vmax = vmax
         self.cmap = cmap
         self.feature_dir = feature_dir
         self.lon_offset = lon_offset
+        self.reuse_figure = reuse_figure
+        self.basemap_dir = basemap_dir
+        self.max_points = max_points
+        self.render_mode = render_mode
+        self.raster_shape = raster_shape
+        self.map_raster_shape = map_raster_shape
+        self.summary = summary
+        self.archive = archive
         self.logger = logger
         self.savefile = None
+        self.artifact = None
+        self.figure = None
+        self.fig = None
+        self.time_vals = None
         self.feature_dir_default = os.path.join(
             os.path.dirname(os.path.realpath(__file__)), 'cartopy_data/')
-         # Initialize S3 client
-        self.s3_client = boto3.client('s3')
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, *exc_info):
+        self._release_figure()
+
+    def _release_figure(self):
+        """
+        Close this plot's figure, unless it is kept for reuse
+        """
+        if self.fig is not None and not self.reuse_figure:
+            plt.close(self.fig)
+        self.fig = None
 
     def _calc_statistics(self):
         """
@@ -86,16 +214,12 @@ class PlotMangopare(object):
         """
         self.logger.error('In plot.py: _calc_statistics')
         try:
-            self.ds['PHASE'] = self.ds['PHASE'].astype(str)
-            bdata = self.ds.where(self.ds['PHASE'] == 'D', drop=True)
-            # if there are no bottom data, then take means of all
-            # measurements in deployment
-            if len(bdata['DATETIME']) < 1:
-                bdata = self.ds
-            tmean = np.nanmean(bdata['TEMPERATURE'].values).round(2)
-            dmean = np.nanmean(bdata['DEPTH'].values).round(1)
-            tmax = np.nanmax(bdata['TEMPERATURE'].values).round(2)
-            tmin = np.nanmin(bdata['TEMPERATURE'].values).round(2)
+            # bottom phase stats, or all measurements in the deployment
+            # if there are no bottom data
+            tmean = np.round(self.summary.bottom_temp_mean, 2)
+            dmean = np.round(self.summary.bottom_depth_mean, 1)
+            tmax = np.round(self.summary.bottom_temp_max, 2)
+            tmin = np.round(self.summary.bottom_temp_min, 2)
             stats = {'mean_temp': tmean, 'mean_depth': dmean,
                      "max_temp": tmax, "min_temp": tmin}
             
@@ -122,25 +246,42 @@ class PlotMangopare(object):
                          self.ax.bbox.ymin-height,zorder=200)
             """
             
-            # Initialize the S3 client
-            s3_client = boto3.client('s3')
-    
-            # Specify the bucket name and key (path) of the logo file in S3
-            bucket_name = 'fishsoop-qc-tools'
-            
-            # Download the logo file from S3
-            self.logger.error(f'Getting logo {self.logo_file} in {bucket_name}')
-            response = s3_client.get_object(Bucket=bucket_name, Key=f'/{self.logo_file}')
-            logo_data = response['Body'].read()
-        
-            im = plt.imread(self.logo_file)
-            newax = self.fig.add_axes([0.53, 0.075, 0.1, 0.1], anchor='NE', zorder=10)
+            # Logo comes from the process-wide asset cache, decoded
+            # once and only downloaded again if it changes in S3
+            self.logger.error(f'Getting logo {self.logo_file}')
+            im = get_asset_cache('fishsoop-qc-tools').get_decoded(
+                f'/{self.logo_file}', _decode_image)
+            # a persistent figure keeps its logo axes for the next file
+            newax = self.figure.logo_ax
+            if newax is None:
+                newax = self.figure.logo_ax = self.fig.add_axes(
+                    [0.53, 0.075, 0.1, 0.1], anchor='NE', zorder=10)
+            else:
+                newax.clear()
             newax.imshow(im)
             newax.axis('off')
+            newax.set_visible(True)
 
         except Exception as exc:
             self.logger.warning(
                 f'Could not add logo to plot for {self.filename} due to {exc}')
+            if self.figure.logo_ax is not None:
+                self.figure.logo_ax.set_visible(False)
+
+    def _format_axes(self, fig, ax, axis_date=True):
+        """
+        Axis labels and date formatting, the same for every file.
+        axis_date is needed when nothing with dates has been drawn yet.
+        """
+        ax.set_xlabel('Date (d-m-y:H:M UTC)')
+        ax.set_ylabel('Depth (m)')
+
+        if axis_date:
+            ax.xaxis.axis_date()
+        fig.autofmt_xdate(rotation=30, ha='right')
+        xfmt = mdates.DateFormatter("%d-%m-%y:%H:%M")
+        ax.xaxis.set_major_formatter(xfmt)
+        ax.xaxis.set_minor_formatter(xfmt)
 
     def _format_plot(self):
         """
@@ -148,14 +289,6 @@ class PlotMangopare(object):
         """
         self.logger.error('In plot.py: _format_plot')
         try:
-            self.ax.set_xlabel('Date (d-m-y:H:M UTC)')
-            self.ax.set_ylabel('Depth (m)')
-
-            self.fig.autofmt_xdate(rotation=30, ha='right')
-            xfmt = mdates.DateFormatter("%d-%m-%y:%H:%M")
-            self.ax.xaxis.set_major_formatter(xfmt)
-            self.ax.xaxis.set_minor_formatter(xfmt)
-
             sn = self.ds.attrs['moana_serial_number']
             if self.ds.attrs['programme_name'] == 'Fish-Soop':
                 self.ax.set_title(
@@ -173,107 +306,182 @@ class PlotMangopare(object):
         temperature, and also max and min temp values
         """
         self.logger.error('In plot.py: _calc_color_range')
-        colors = np.array(self.ds['TEMPERATURE'].values)
+        colors = np.asarray(self.ds['TEMPERATURE'].values)
         if not (self.vmin and self.vmax):
-            self.vmin = np.nanmin(colors)
-            self.vmax = np.nanmax(colors)
+            self.vmin = self.summary.temp_min
+            self.vmax = self.summary.temp_max
             if self.vmin == self.vmax:
                 self.vmin = self.vmin-1
                 self.vmax = self.vmax+1
         return(colors)
 
+    @staticmethod
+    def _thin(keep, *arrays):
+        """
+        arrays at the positions in keep, or unchanged (no copies) if
+        keep is all of them
+        """
+        if len(keep) == len(arrays[0]):
+            return(arrays)
+        return([array[keep] for array in arrays])
+
+    def _decimate(self, x, ys, name):
+        """
+        Positions of the points to draw, see max_points
+        """
+        keep = decimate_extremes(x, ys, self.max_points)
+        if len(keep) < len(x):
+            self.logger.error(
+                f'In plot.py: {name} of {self.filename}: dropped {len(x) - len(keep)} of {len(x)} points')
+        return(keep)
+
     def _set_axes_limits(self, time_frac=0.1):
         """
         Calculates max and min times, sets x- and y-
         axes limits
         """
         self.logger.error('In plot.py: _set_axes_limits')
-        tmax = np.nanmax(self.ds['DATETIME'].values)
-        tmin = np.nanmin(self.ds['DATETIME'].values)
+        tmax = self.summary.time_max
+        tmin = self.summary.time_min
         timerange = tmax-tmin
         td = timerange*time_frac
         self.ax.set_xlim([tmin-td, tmax+td])
-        self.ax.set_ylim([np.nanmax(self.ds['DEPTH'])+5, 0])
+        self.ax.set_ylim([self.summary.depth_max+5, 0])
         time_vals = [tmin, tmax]
         return(time_vals)
 
-    def _add_inset_map(self, gridoff=0.1):
+    def _add_inset_map(self, figure):
+        """
+        Add the inset map axes, the gridlines and, for a persistent
+        figure, an empty scatter and image to figure
+        """
         self.logger.error('In plot.py: _add_inset_map')
-        self.axins = None
+        figure.axins = None
         try:
-            transform = blended_transform_factory(self.fig.transFigure, self.ax.transAxes)
-            self.axins = inset_axes(self.ax, width="25%", height="60%",
+            transform = blended_transform_factory(figure.fig.transFigure, figure.ax.transAxes)
+            figure.axins = inset_axes(figure.ax, width="25%", height="60%",
                                bbox_to_anchor=(0.3, 0.2, 1, 1),
                                bbox_transform=transform, loc=8,
                                borderpad=0, axes_class=cmpl.geoaxes.GeoAxes,
                                axes_kwargs=dict(projection=ccrs.PlateCarree(central_longitude=self.lon_offset)))
 
-            lon = self.ds['LONGITUDE'].values
-            lat = self.ds['LATITUDE'].values
-            temp = self.ds['TEMPERATURE'].values
-
-            box = [np.nanmin(lon % 360)-gridoff, np.nanmax(lon % 360)
-                   + gridoff, np.nanmin(lat)-gridoff, np.nanmax(lat)+gridoff]
-            self.axins.set_extent(box, crs=ccrs.PlateCarree())
-
-            # Using gshhs
-            #bucket_name = 'fishsoop-qc-tools'
-            #prefix = 'Coast/osm_land_polygons/'
-    
-            # List objects in the folder
-            #response = self.s3_client.list_objects_v2(Bucket=bucket_name, Prefix=prefix)
-            
-            # Extract object keys from the response
-            #object_keys = [obj['Key'] for obj in response.get('Contents', [])]
-            
-            #self.logger.error(f'Object keys in {prefix} in {bucket_name}: {object_keys}')
-
-            # Download and load shapefiles
-            #for obj in object_keys:
-            #    if obj.endswith('.shp'):
-            #        self.logger.error(f'obj in loop is: {obj}')
-                    # Download the shapefile
-                    #try:
-                    #    resp = self.s3_client.get_object(Bucket=bucket_name, Key=obj)
-                    #    self.logger.error(f'Downloaded object: {bucket_name}/{obj}')
-                        
-                    #    # Load the shapefile using Cartopy directly from the streaming body
-                    #    shp = shpreader.Reader(shp=io.BytesIO(resp['Body'].read()))
-                    #    self.logger.error(f'Read object: {bucket_name}/{obj}')
-            
-                    #    # Process the shapefile as needed
-                    #    # For example, add geometries to the map
-                    #    self.axins.add_geometries(shp.geometries(), ccrs.PlateCarree(),
-                    #                               edgecolor='black', facecolor='none')
-            
-                    #except Exception as e:
-                    #    self.logger.error(f"Error processing shapefile {obj}: {e}")
-
-            
-            # Using gshhs
-            #shpfile = cartopy.io.shapereader.gshhs('h')
-            #shp = cartopy.io.shapereader.Reader(shpfile)
-            
-            #self.axins.add_geometries(shp.geometries(), ccrs.PlateCarree(
-            #    ), edgecolor='black', facecolor=cfeature.COLORS['land'])
+            # Land and coastline come from pre-rasterised tiles, drawn
+            # as an image under the scatter, see _set_basemap
+            figure.land = None
+            if self._get_basemap().available():
+                figure.land = figure.axins.imshow(
+                    np.zeros((1, 1, 4), dtype=np.uint8), extent=[-1, 1, -1, 1],
+                    transform=figure.axins.projection, interpolation='nearest', zorder=0)
+            else:
+                self.logger.warning('No basemap tiles found, the map has no land')
 
-            self.axins.scatter(lon+self.lon_offset, lat, s=10, c=temp,
-                          cmap=self.cmap, vmin=self.vmin, vmax=self.vmax, zorder=100)
-            gl = self.axins.gridlines(crs=ccrs.PlateCarree(), draw_labels=True,
+            figure.map_dot = figure.map_img = None
+            if figure.persistent:
+                figure.map_dot = figure.axins.scatter([], [], s=10, c=[],
+                              cmap=self.cmap, norm=figure.norm, zorder=100)
+                figure.map_img = figure.axins.imshow(
+                    np.full((1, 1), np.nan), extent=[-1, 1, -1, 1], origin='lower',
+                    transform=figure.axins.projection, interpolation='nearest',
+                    cmap=self.cmap, norm=figure.norm, zorder=50)
+            gl = figure.axins.gridlines(crs=ccrs.PlateCarree(), draw_labels=True,
                                  linewidth=1, color='gray', alpha=0.5, linestyle='--')
             gl.xlines = True
-            gl.xlocator = mticker.FixedLocator(np.round(np.linspace(
-                np.nanmin(lon)-gridoff, np.nanmax(lon)+gridoff, 4), 1))
             gl.xformatter = LONGITUDE_FORMATTER
             gl.yformatter = LATITUDE_FORMATTER
             gl.xlabel_style = {'size': 15, 'color': 'black'}
             gl.xlabel_style = {'color': 'black'}
             gl.right_labels = gl.top_labels = False
+            figure.gl = gl
+        except Exception as exc:
+            self.logger.warning(
+                f'Could not add map axes because {exc}')
+            if figure.axins:
+                figure.axins.remove()
+            figure.axins = None
+
+    def _get_basemap(self):
+        basemap = _BASEMAPS.get(self.basemap_dir)
+        if basemap is None:
+            basemap = Basemap(data_dir=self.basemap_dir, logger=self.logger)
+            # only kept once tiles are found, so tiles that appear later
+            # (e.g. unpacked into /tmp) are picked up
+            if basemap.available():
+                _BASEMAPS[self.basemap_dir] = basemap
+        return(basemap)
+
+    def _set_basemap(self, box):
+        """
+        Show the land/coast image for box ([lon_min, lon_max, lat_min,
+        lat_max], longitudes 0-360) under the inset map scatter
+        """
+        land = self.figure.land
+        if land is None:
+            # no tiles, see _add_inset_map
+            return
+        land.set_visible(False)
+        rgba, extent = self._get_basemap().image(box)
+        if rgba is None:
+            return
+        # image extent in the map's own coordinates, which are centred
+        # on lon_offset
+        x0, x1 = [((lon - self.lon_offset + 180) % 360) - 180 for lon in extent[:2]]
+        if x1 <= x0:
+            return
+        land.set_data(rgba)
+        land.set_extent([x0, x1, extent[2], extent[3]])
+        land.set_visible(True)
+
+    def _set_inset_map_data(self, gridoff=0.1):
+        """
+        Zoom the inset map to this deployment and plot its positions
+        """
+        self.logger.error('In plot.py: _set_inset_map_data')
+        if not self.axins:
+            return
+        try:
+            lon = self.ds['LONGITUDE'].values
+            lat = self.ds['LATITUDE'].values
+            temp = self.ds['TEMPERATURE'].values
+
+            summary = self.summary
+            box = [summary.lon360_min-gridoff, summary.lon360_max
+                   + gridoff, summary.lat_min-gridoff, summary.lat_max+gridoff]
+            self.axins.set_extent(box, crs=ccrs.PlateCarree())
+            self._set_basemap(box)
+
+            figure = self.figure
+            raster = self.render_mode == 'raster'
+            if raster:
+                # same map coordinates as the scatter
+                grid, extent = bin_mean(lon+self.lon_offset, lat, temp, self.map_raster_shape)
+                grid = np.ma.masked_invalid(grid)
+                if figure.persistent:
+                    figure.map_img.set_data(grid)
+                    figure.map_img.set_extent(extent)
+                else:
+                    figure.map_img = self.axins.imshow(
+                        grid, extent=extent, origin='lower', transform=self.axins.projection,
+                        interpolation='nearest', cmap=self.cmap, vmin=self.vmin,
+                        vmax=self.vmax, zorder=50)
+            else:
+                lon, lat, temp = self._thin(self._decimate(lon, [lat, temp], 'map'),
+                                            lon, lat, temp)
+                if figure.persistent:
+                    figure.map_dot.set_offsets(np.column_stack([lon+self.lon_offset, lat]))
+                    figure.map_dot.set_array(temp)
+                else:
+                    figure.map_dot = self.axins.scatter(lon+self.lon_offset, lat, s=10, c=temp,
+                                  cmap=self.cmap, vmin=self.vmin, vmax=self.vmax, zorder=100)
+            if figure.persistent:
+                figure.map_img.set_visible(raster)
+                figure.map_dot.set_visible(not raster)
+            self.figure.gl.xlocator = mticker.FixedLocator(np.round(np.linspace(
+                summary.lon_min-gridoff, summary.lon_max+gridoff, 4), 1))
+            self.axins.set_visible(True)
         except Exception as exc:
             self.logger.warning(
                 f'Skipped map for {self.filename} because {exc}')
-            if self.axins:
-                self.axins.remove()
+            self.axins.set_visible(False)
 
     def _set_outfile(self):
         self.logger.error('In plot.py: _set_outfile')
@@ -295,53 +503,157 @@ class PlotMangopare(object):
             self.logger.warning(
                 f'Could not calculate name to save plot because {exc}')
 
+    def _build_figure(self, figsize, persistent=False):
+        """
+        Build the parts of the figure that do not depend on the data:
+        axes and the inset map, and for a persistent figure also the
+        empty scatter and image, colorbar and formatters.  A persistent
+        figure is not registered with pyplot, so it survives plt.close()
+        and can be kept between files.
+        """
+        self.logger.error('In plot.py: _build_figure')
+        figure = _PlotFigure()
+        figure.persistent = persistent
+        mpl.rcParams.update({'font.size': 12})
+        if persistent:
+            figure.fig = mpl.figure.Figure(figsize=figsize)
+        else:
+            figure.fig = plt.figure(figsize=figsize)
+        try:
+            self._build_axes(figure)
+        except Exception:
+            # not handed out yet, so nobody else would close it
+            if not persistent:
+                plt.close(figure.fig)
+            raise
+        return(figure)
+
+    def _build_axes(self, figure):
+        gs = gridspec.GridSpec(nrows=1, ncols=2, width_ratios=[2, 1], figure=figure.fig)
+        figure.ax = figure.fig.add_subplot(gs[0])
+
+        figure.fig.subplots_adjust(bottom=.25)
+
+        figure.dot_c = figure.dot_img = None
+        if figure.persistent:
+            # one norm for the scatter, the map and the colorbar, so a
+            # single set_clim updates all of them
+            figure.norm = mpl.colors.Normalize()
+            figure.dot_c = figure.ax.scatter([], [], c=[], cmap=self.cmap, norm=figure.norm)
+            figure.dot_img = figure.ax.imshow(
+                np.full((1, 1), np.nan), extent=[0, 1, 0, 1], origin='lower', aspect='auto',
+                interpolation='nearest', cmap=self.cmap, norm=figure.norm)
+            figure.fig.colorbar(
+                figure.dot_c, label="Temperature ($^\circ$C)", ax=figure.ax)
+            self._format_axes(figure.fig, figure.ax)
+        if self.add_map:
+            self._add_inset_map(figure)
+        else:
+            figure.axins = None
+
+    def _get_figure(self, figsize):
+        """
+        Returns a new figure, or in reuse_figure mode the figure kept
+        from a previous file with the same layout and colormap
+        """
+        if not self.reuse_figure:
+            return(self._build_figure(figsize))
+        key = (tuple(figsize), self.add_map, self.lon_offset,
+               getattr(self.cmap, 'name', str(self.cmap)))
+        if key not in _FIGURES:
+            _FIGURES[key] = self._build_figure(figsize, persistent=True)
+        return(_FIGURES[key])
+
+    def _draw_depth_time(self, colors):
+        """
+        Depth-time scatter (or raster) of this file: swapped into the
+        placeholders of a persistent figure, otherwise drawn with its
+        colorbar and formatters
+        """
+        figure = self.figure
+        times = self.ds['DATETIME'].values
+        depth = self.ds['DEPTH'].values
+        raster = self.render_mode == 'raster'
+        if figure.persistent:
+            figure.dot_c.set_clim(self.vmin, self.vmax)
+        if raster:
+            # row 0 is the shallowest, which the inverted depth
+            # axis puts at the top
+            grid, extent = bin_mean(mdates.date2num(times), depth, colors, self.raster_shape)
+            grid = np.ma.masked_invalid(grid)
+            if figure.persistent:
+                figure.dot_img.set_data(grid)
+                figure.dot_img.set_extent(extent)
+            else:
+                figure.dot_img = figure.ax.imshow(
+                    grid, extent=extent, origin='lower', aspect='auto', interpolation='nearest',
+                    cmap=self.cmap, vmin=self.vmin, vmax=self.vmax)
+            mappable = figure.dot_img
+        else:
+            keep = self._decimate(mdates.date2num(times), [depth, colors], 'depth-time plot')
+            times, depth, colors = self._thin(keep, times, depth, colors)
+            if figure.persistent:
+                figure.dot_c.set_offsets(np.column_stack([mdates.date2num(times), depth]))
+                figure.dot_c.set_array(colors)
+            else:
+                figure.dot_c = figure.ax.scatter(times, depth, c=colors, cmap=self.cmap,
+                                                 vmin=self.vmin, vmax=self.vmax)
+            mappable = figure.dot_c
+        if figure.persistent:
+            figure.dot_img.set_visible(raster)
+            figure.dot_c.set_visible(not raster)
+        else:
+            figure.fig.colorbar(
+                mappable, label="Temperature ($^\circ$C)", ax=figure.ax)
+            # a raster image has no dates for the axis to pick up
+            self._format_axes(figure.fig, figure.ax, axis_date=raster)
+
     def _create_plot(self, colors, fontsize=12, figsize=(12, 5.5)):
         self.logger.error('In plot.py: _create_plot')
         try:
-            mpl.rcParams.update({'font.size': 12})
-            self.fig = plt.figure(figsize=figsize)
-            gs = gridspec.GridSpec(nrows=1, ncols=2, width_ratios=[2, 1])
-            self.ax = self.fig.add_subplot(gs[0])
-
-            plt.subplots_adjust(bottom=.25)
+            self.figure = self._get_figure(figsize)
+            self.fig = self.figure.fig
+            self.ax = self.figure.ax
+            self.axins = self.figure.axins
 
-            dot_c = self.ax.scatter(self.ds['DATETIME'].values, self.ds['DEPTH'].values,
-                                    c=colors, cmap=self.cmap, vmin=self.vmin, vmax=self.vmax)
-            self.fig.colorbar(
-                dot_c, label="Temperature ($^\circ$C)", ax=self.ax)
+            self._draw_depth_time(colors)
 
             self.time_vals = self._set_axes_limits()
             self._format_plot()
 
-            self._add_inset_map()
+            self._set_inset_map_data()
 
             self._calc_statistics()
             self.logger.error('In plot.py: back to _create_plot after _calc_statistics')
 
-            #if self.logo_file:
-            #    self._add_logo()
+            if self.add_logo and self.logo_file:
+                self._add_logo()
+            elif self.figure.logo_ax is not None:
+                self.figure.logo_ax.set_visible(False)
 
             #plt.savefig(self.savefile, dpi=75, bbox_inches='tight', pad_inches=0.25, transparent=False)
             
-            # Convert plot image to bytes buffer
+            # Convert plot image to bytes buffer.  A reused figure has a
+            # fixed layout, so skip the extra draw a tight bbox needs
             buffer = io.BytesIO()
-            plt.savefig(buffer, dpi=75, bbox_inches='tight', pad_inches=0.25, transparent=False)
-            buffer.seek(0)
+            if self.reuse_figure:
+                self.fig.savefig(buffer, dpi=75, transparent=False)
+            else:
+                self.fig.savefig(buffer, dpi=75, bbox_inches='tight', pad_inches=0.25, transparent=False)
             self.logger.error('In plot.py: _create_plot after the buffer image to bytes')
             
-            # Upload plot image to S3
-            png_filename = os.path.splitext(os.path.basename(self.filename))[0] + '.png'
-            self.logger.error(f'Saving the plot {png_filename} in {self.savefile}')
-            
             # Remove slash from self.savefile if it exists
             if self.savefile.startswith('/'):
                 self.savefile = self.savefile[1:]
-
-            self.s3_client.put_object(
-                Body=buffer,
-                Bucket='fishsoop-email', 
-                Key=f'{self.savefile}'
-            )
+            
+            # Archive the plot in S3 in the background, the email
+            # gets the bytes directly
+            self.logger.error(f'Saving the plot in {self.savefile}')
+            self.artifact = Artifact(os.path.basename(self.savefile), buffer.getvalue(),
+                                     'image/png', bucket_name='fishsoop-email',
+                                     key=self.savefile, logger=self.logger)
+            if self.archive:
+                self.artifact.archive()
             
             # Remove folder name from plot filename
             self.savefile = os.path.basename(self.savefile)
@@ -355,9 +667,13 @@ class PlotMangopare(object):
     def _set_cartopy_config(self):
         """
         Use local coastline and land files if available to avoid downloads
-        when possible/necessary
+        when possible/necessary.  cartopy can only read a local directory.
         """
         self.logger.error('In plot.py: _set_cartopy_config')
+        if self.feature_dir and '://' in self.feature_dir:
+            self.logger.warning(
+                f'cartopy cannot read {self.feature_dir}, using {self.feature_dir_default}')
+            self.feature_dir = None
         if not self.feature_dir:
             self.feature_dir = self.feature_dir_default
         cartopy.config['pre_existing_data_dir'] = self.feature_dir
@@ -365,15 +681,72 @@ class PlotMangopare(object):
     def run(self):
         self.logger.error('In plot.py: run')
         try:
+            _import_plotting()
+            if self.cmap is None:
+                self.cmap = cmo.cm.thermal
+            if self.summary is None:
+                self.summary = DeploymentSummary(self.ds, logger=self.logger)
             self._set_cartopy_config()
             self._set_outfile()
             colors = self._calc_color_range()
             self._create_plot(colors)
-            plt.close(self.fig)
             #if os.path.isfile(self.savefile):
-            return(self.savefile, self.time_vals)
+            return(self.artifact, self.time_vals)
             #else:
             #    return(None, None)
         except Exception as exc:
             self.logger.error(f'Did not save {self.savefile} due to {exc}')
             return(None, None)
+        finally:
+            if plt is not None:
+                self._release_figure()
+
+
+
+def plot_inputs(ds):
+    """
+    The arrays and attributes of ds that PlotMangopare uses, as plain
+    numpy and dicts so they can be sent to another process cheaply
+    """
+    data = {var: ds[var].values for var in PLOT_VARIABLES if var in ds.variables}
+    var_attrs = {var: dict(ds[var].attrs) for var in data}
+    return({'data': data, 'var_attrs': var_attrs, 'attrs': dict(ds.attrs)})
+
+
+def render_plot(inputs, filename, **kwargs):
+    """
+    Process pool entry point: rebuild a dataset from plot_inputs(ds)
+    and plot it.  The png is not archived here, the caller gets
+    (name, data, bucket_name, key) back and archives it.
+    Input:
+        inputs: output of plot_inputs
+        filename: as for PlotMangopare
+        kwargs: other PlotMangopare arguments
+    Output:
+        (name, data, bucket_name, key) of the png, or None if the plot
+        failed, and the time range of the plot
+    """
+    import xarray as xr
+    data = dict(inputs['data'])
+    times = data.pop('DATETIME')
+    var_attrs = inputs.get('var_attrs', {})
+    ds = xr.Dataset({var: ('DATETIME', values, var_attrs.get(var, {}))
+                     for var, values in data.items()},
+                    coords={'DATETIME': times}, attrs=inputs['attrs'])
+    artifact, time_vals = PlotMangopare(ds, filename, archive=False, **kwargs).run()
+    if artifact is None:
+        return(None, time_vals)
+    return((artifact.name, artifact.data, artifact.bucket_name, artifact.key), time_vals)
+
+
+def render_params(**kwargs):
+    """
+    The values of RENDER_PARAMS a PlotMangopare made with kwargs would
+    use, defaults filled in and the colormap as its name, for keying
+    cached plots (see derived.py)
+    """
+    parameters = inspect.signature(PlotMangopare.__init__).parameters
+    params = {name: kwargs.get(name, parameters[name].default) for name in RENDER_PARAMS}
+    cmap = params['cmap']
+    params['cmap'] = 'cmocean.thermal' if cmap is None else getattr(cmap, 'name', str(cmap))
+    return(params)
@@ -0,0 +1,97 @@
+"""
+Reduce deployment data to what can actually be seen in a plot, before
+it is handed to matplotlib.  Everything here is plain numpy so it can
+be used without the plotting libraries loaded.
+"""
+import numpy as np
+
+
+def _columns(x, n_columns):
+    """
+    Index of the pixel column each x falls in, for n_columns
+    equal columns spanning the range of x
+    """
+    x = np.asarray(x, dtype=float)
+    x_min, x_max = np.nanmin(x), np.nanmax(x)
+    if not x_max > x_min:
+        return(np.zeros(len(x), dtype=np.int64))
+    col = np.floor((np.nan_to_num(x, nan=x_min) - x_min) / (x_max - x_min) * n_columns)
+    return(np.clip(col, 0, n_columns - 1).astype(np.int64))
+
+
+def _first_per_group(groups, values):
+    """
+    Position of the smallest value in each group, NaN never wins
+    """
+    order = np.lexsort((np.where(np.isnan(values), np.inf, values), groups))
+    sorted_groups = groups[order]
+    starts = np.flatnonzero(np.r_[True, sorted_groups[1:] != sorted_groups[:-1]])
+    return(order[starts])
+
+
+def decimate_extremes(x, ys, max_points):
+    """
+    Choose at most about max_points samples that draw the same picture
+    as all of them.  x (time for the depth-time plot, longitude for the
+    map) is split into pixel columns, and in each column only the
+    samples with the smallest and largest value of every array in ys
+    (e.g. depth and temperature) are kept, so the outline of the data and
+    its colour extremes survive.
+    Input:
+        x: values along the horizontal axis
+        ys: list of arrays, the same length as x, whose extremes are kept
+        max_points: point budget, None to keep everything
+    Output:
+        sorted positions of the samples to keep
+    """
+    n = len(x)
+    if not max_points or n <= max_points:
+        return(np.arange(n))
+    n_columns = max(1, max_points // (2 * len(ys)))
+    col = _columns(x, n_columns)
+    keep = []
+    for y in ys:
+        y = np.asarray(y, dtype=float)
+        keep.append(_first_per_group(col, y))
+        keep.append(_first_per_group(col, -y))
+    return(np.unique(np.concatenate(keep)))
+
+
+def bin_mean(x, y, values, shape, x_range=None, y_range=None):
+    """
+    Mean of values in each cell of a regular grid over x and y, so a
+    deployment of any size can be drawn as one image.
+    Input:
+        x, y: sample coordinates (e.g. time and depth, or lon and lat)
+        values: sample values to average (e.g. temperature)
+        shape: (rows, columns) of the grid, rows along y
+        x_range, y_range: (min, max) covered by the grid, the range of
+        the data if None
+    Output:
+        grid: array of the given shape, NaN in empty cells, row 0 at
+        y_range[0]
+        extent: [x_min, x_max, y_min, y_max] of the grid
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    values = np.asarray(values, dtype=float)
+    ok = np.isfinite(x) & np.isfinite(y) & np.isfinite(values)
+    x, y, values = x[ok], y[ok], values[ok]
+    n_rows, n_cols = shape
+    if len(x) == 0:
+        return(np.full(shape, np.nan), [0., 1., 0., 1.])
+    x0, x1 = x_range if x_range else (x.min(), x.max())
+    y0, y1 = y_range if y_range else (y.min(), y.max())
+    # a single column/row of samples still gets a cell of some size
+    if not x1 > x0:
+        x0, x1 = x0 - 0.5, x1 + 0.5
+    if not y1 > y0:
+        y0, y1 = y0 - 0.5, y1 + 0.5
+    col = np.clip(np.floor((x - x0) / (x1 - x0) * n_cols), 0, n_cols - 1).astype(np.int64)
+    row = np.clip(np.floor((y - y0) / (y1 - y0) * n_rows), 0, n_rows - 1).astype(np.int64)
+    cell = row * n_cols + col
+    sums = np.bincount(cell, weights=values, minlength=n_rows * n_cols)
+    counts = np.bincount(cell, minlength=n_rows * n_cols)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        grid = sums / counts
+    return(grid.reshape(shape), [x0, x1, y0, y1])
@@ -1,9 +1,32 @@
 import sys
 import os
 import re
+import io
 import logging
-import boto3
+import tempfile
+import netCDF4
+import numpy as np
+import pandas as pd
 import xarray as xr
+from ops_mangopare.aws import get_s3_client, split_s3_path, TRANSFER_CONFIG, S3RangeFile
+from ops_mangopare.artifacts import Artifact
+from ops_mangopare.cache import get_local_cache
+from ops_mangopare.summary import DeploymentSummary
+
+# Everything the plot, email and csv use
+KEEP_VARIABLES = ['DATETIME', 'LATITUDE', 'LONGITUDE', 'TEMPERATURE',
+                  'DEPTH', 'QC_FLAG', 'PHASE']
+
+# csv column for each variable, in file order after 'DATETIME [UTC]'
+CSV_COLUMNS = {'LATITUDE': 'LATITUDE', 'LONGITUDE': 'LONGITUDE',
+               'TEMPERATURE': 'TEMPERATURE [degC]', 'DEPTH': 'DEPTH [m]',
+               'QC_FLAG': 'QC_FLAG'}
+
+# A csv larger than this is written to a temporary file instead of memory
+CSV_SPOOL_BYTES = 8 * 1024 * 1024
+
+# Set once peek has warned that h5netcdf is not installed
+_H5NETCDF_WARNED = False
 
 class MangopareNetCDFReader(object):
     """
@@ -22,9 +45,44 @@ class MangopareNetCDFReader(object):
         all values...this only filters for the plot.
         out_dir: where to save the csv file.  If none, it uses the
         directory that filename is in.
+        in_memory: download the netCDF file into memory and open it
+        from there instead of from a file in /tmp.  Otherwise the file
+        is downloaded into the local cache (cache.LocalCache) and opened
+        there.  Either way, when etag is given a retry of the same file
+        is a cache hit and does not download it again.
+        csv_chunk_size: number of rows converted and written at a time
+        when saving the csv.  The csv goes into a spooled temporary file
+        (in memory up to CSV_SPOOL_BYTES, then on disk) and is uploaded
+        from there, so building it never holds the whole table; the
+        email attachment still reads it into memory once.
+        variables: variables to load, all others in the file are never
+        read.  None loads everything.
+        compact_dtypes: keep the QC filtered ds small: TEMPERATURE and
+        DEPTH as float32, QC_FLAG as int8 and PHASE as int8 codes with
+        the phase names in its 'categories' attribute (see
+        summary.phase_mask).  LATITUDE and LONGITUDE keep full
+        precision, and the csv is written from the unfiltered data
+        unchanged.
+        chunk_size: streaming mode for very long deployments.  The file
+        is always read from disk through the local cache (in_memory is
+        ignored), and in a single pass of chunk_size samples at a time:
+        each chunk is decoded once and gives its csv rows, its QC mask,
+        its good rows (compacted as above, so compact_dtypes applies
+        here too) and its part of the summary.DeploymentSummary, which
+        is kept as summary.  Only the QC filtered ds is held whole.
+        etag, size: ETag and size of the S3 object, if the caller has
+        them already (e.g. from its duplicate check).  Saves the HEAD
+        requests peek and the local cache would otherwise make.
     Output:
         ds: xarray dataset with the data from filename
-        csv_file: path and filename for the saved csv_file
+        summary: with chunk_size, the summary.DeploymentSummary of ds
+        made while reading, otherwise None
+        csv_file: artifacts.Artifact holding the csv, already being
+        archived to S3 in the background.  Close it when done with it.
+    peek() reads only the global attributes and dimension sizes, so a
+    caller can decide whether the file is worth reading at all.
+    close() (or using the reader as a context manager) releases the
+    open file behind ds and dsall; run() does it itself if it fails.
     """
 
     def __init__(self,
@@ -32,12 +90,219 @@ class MangopareNetCDFReader(object):
                  save_csv=True,
                  qc_keep=[1, 2],
                  out_dir=None,
+                 in_memory=True,
+                 csv_chunk_size=50000,
+                 variables=KEEP_VARIABLES,
+                 compact_dtypes=True,
+                 chunk_size=None,
+                 etag=None,
+                 size=None,
                  logger=logging):
         self.filename = filename
         self.save_csv = save_csv
         self.qc_keep = qc_keep
         self.out_dir = out_dir
+        self.in_memory = in_memory
+        self.csv_chunk_size = csv_chunk_size
+        self.variables = variables
+        self.compact_dtypes = compact_dtypes
+        self.chunk_size = chunk_size
+        self.etag = etag
+        self.size = size
         self.logger = logger
+        self.ds = None
+        self.dsall = None
+        self.summary = None
+        self._csv_out = None
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Close ds and dsall and the file they read from
+        """
+        for ds in (self.ds, self.dsall):
+            if ds is None:
+                continue
+            try:
+                ds.close()
+            except Exception as exc:
+                self.logger.warning(f'Could not close {self.filename} due to {exc}')
+        if self._csv_out is not None:
+            self._csv_out.close()
+            self._csv_out = None
+
+    def _open_from_memory(self, bucket_name, object_key):
+        """
+        Download the object into a memory buffer (large objects are
+        fetched as parallel byte ranges) and let netCDF4 open it from
+        there.  netCDF4 reads the buffer in place (getbuffer(), not a
+        getvalue() copy), so the file is held in memory once.  With a
+        known etag the local cache is used as well: a cached copy is
+        opened from disk instead of downloading, and a download is
+        written to the cache in the background, off the read path, so
+        a retry of the same file is a hit.
+        """
+        self.logger.error('In readers.py: _open_from_memory')
+        local_cache = get_local_cache()
+        if self.etag:
+            local_file_path = local_cache.lookup(bucket_name, object_key, self.etag)
+            if local_file_path:
+                self.logger.error(f'In readers.py: cache hit for {object_key}')
+                return(xr.open_dataset(local_file_path))
+        buffer = io.BytesIO()
+        get_s3_client().download_fileobj(bucket_name, object_key, buffer,
+                                         Config=TRANSFER_CONFIG)
+        ds = self._open_bytes(os.path.basename(object_key), buffer.getbuffer())
+        if self.etag:
+            local_cache.put_bytes_later(bucket_name, object_key, self.etag, buffer.getbuffer())
+        return(ds)
+
+    def _open_bytes(self, name, data):
+        """
+        Open the contents of a netCDF file held in memory.  data is
+        anything with the buffer interface (bytes, bytearray,
+        memoryview) and must not change while the file is open.
+        """
+        nc = netCDF4.Dataset(name, mode='r', memory=data)
+        return(xr.open_dataset(xr.backends.NetCDF4DataStore(nc),
+                               cache=not self.chunk_size))
+
+    @staticmethod
+    def _attr_value(value):
+        if isinstance(value, bytes):
+            return(value.decode('utf-8', 'replace'))
+        if isinstance(value, np.generic):
+            return(value.item())
+        return(value)
+
+    def peek(self):
+        """
+        Global attributes and dimension sizes of filename, without
+        reading any variables.  netCDF-4 (HDF5) files are opened with
+        h5netcdf over ranged S3 reads, so only the blocks holding the
+        header are fetched.  Sizes are before QC filtering.
+        Output:
+            attrs: dict of global attributes
+            sizes: dict of dimension sizes
+            (None, None) if the header cannot be read this way (classic
+            netCDF, no h5netcdf); the caller should read the full file
+        h5netcdf is optional; without it every file is read in full, and
+        a warning says so once per process.
+        """
+        global _H5NETCDF_WARNED
+        self.logger.error('In readers.py: peek')
+        try:
+            import h5netcdf
+        except ImportError:
+            if not _H5NETCDF_WARNED:
+                _H5NETCDF_WARNED = True
+                self.logger.warning('In readers.py: h5netcdf is not installed, '
+                                    'files are read in full instead of peeking at their header')
+            return(None, None)
+        try:
+            bucket_name, object_key = split_s3_path(self.filename)
+            fileobj = S3RangeFile(bucket_name, object_key, block_size=64 * 1024,
+                                  size=self.size)
+            if not fileobj.read(4) == b'\x89HDF':
+                return(None, None)
+            fileobj.seek(0)
+            with h5netcdf.File(fileobj, 'r') as nc:
+                attrs = {name: self._attr_value(value) for name, value in nc.attrs.items()}
+                sizes = {name: dim if isinstance(dim, int) else len(dim)
+                         for name, dim in nc.dimensions.items()}
+            self.logger.error(
+                f'In readers.py: peeked at {self.filename} with {fileobj.requests} range requests')
+            return(attrs, sizes)
+        except Exception as exc:
+            self.logger.warning(f'Could not peek at {self.filename} due to {exc}')
+            return(None, None)
+
+    def _select_variables(self, ds):
+        """
+        Drop the variables not in self.variables.  ds is still lazy, so
+        the dropped ones are never read from the file.
+        """
+        if not self.variables:
+            return(ds)
+        keep = [name for name in ds.data_vars if name in self.variables]
+        return(ds[keep])
+
+    @staticmethod
+    def _encode_phase(phase, categories=None):
+        """
+        PHASE as int8 codes, with the phase names as 'categories'.
+        Chunks of one file share a categories list, so their codes
+        agree; names not in it yet are appended.
+        """
+        names, codes = np.unique(np.asarray(phase.values), return_inverse=True)
+        names = [name.decode('utf-8') if isinstance(name, bytes) else str(name)
+                 for name in names]
+        if categories is None:
+            categories = names
+        for name in names:
+            if name not in categories:
+                categories.append(name)
+        lookup = np.array([categories.index(name) for name in names], dtype=np.int8)
+        attrs = dict(phase.attrs, categories=categories)
+        return(xr.Variable(phase.dims, lookup[codes].reshape(phase.shape), attrs))
+
+    def _compact_var(self, name, var, categories=None):
+        """
+        Smaller dtype for one QC filtered variable, see compact_dtypes
+        """
+        if name in ('TEMPERATURE', 'DEPTH') and var.dtype.kind == 'f' and var.dtype.itemsize > 4:
+            return(var.astype(np.float32))
+        # only flags in qc_keep are left, so there are no missing values
+        if name == 'QC_FLAG':
+            return(var.astype(np.int8))
+        if name == 'PHASE' and 'categories' not in var.attrs:
+            return(self._encode_phase(var, categories))
+        return(var)
+
+    def _select_rows(self, ds, index, categories=None):
+        """
+        ds.isel(DATETIME=index), one variable at a time.  With
+        compact_dtypes each variable is converted as soon as its rows
+        are selected, so only one variable at a time is ever held in
+        both its file dtype and its small one.  categories is passed
+        on to _encode_phase.
+        """
+        selected = ds.drop_vars(list(ds.data_vars)).isel(DATETIME=index)
+        for name, var in ds.data_vars.items():
+            var = var.variable
+            if 'DATETIME' in var.dims:
+                var = var.isel(DATETIME=index)
+            if self.compact_dtypes:
+                var = self._compact_var(name, var, categories)
+            selected[name] = var
+        return(selected)
+
+    def _good_mask(self):
+        """
+        Boolean mask along DATETIME of the samples to keep: QC_FLAG is
+        in qc_keep and no data variable is missing.  These are the rows
+        the old where(good).dropna() kept, but indexing with the mask
+        leaves every variable in its original dtype.
+        """
+        return(self._good_mask_of(self.dsall))
+
+    def _good_mask_of(self, ds):
+        good = np.isin(ds['QC_FLAG'].values, self.qc_keep)
+        for name, var in ds.data_vars.items():
+            # only these dtypes can hold NaN/NaT/None
+            if 'DATETIME' not in var.dims or var.dtype.kind not in 'fcmMO':
+                continue
+            missing = var.isnull()
+            other_dims = [dim for dim in var.dims if dim != 'DATETIME']
+            if other_dims:
+                missing = missing.any(dim=other_dims)
+            good &= ~missing.values
+        return(good)
 
     def _read_netcdf(self):
         """
@@ -47,28 +312,106 @@ class MangopareNetCDFReader(object):
         self.logger.error('In readers.py: _read_netcdf')
         try:
             # Extract the bucket name and object key from the S3 path
-            bucket_name, object_key = self.filename.replace('s3://', '').split('/', 1)
+            bucket_name, object_key = split_s3_path(self.filename)
             
             self.logger.error(f'In readers.py: reading file {object_key} from bucket {bucket_name}')
             
-            # Initialize boto3 S3 client
-            s3 = boto3.client('s3')
-
-            # Download the file from S3
-            local_file_path = '/tmp/' + os.path.basename(object_key)
-            s3.download_file(bucket_name, object_key, local_file_path)
+            if self.in_memory and not self.chunk_size:
+                self.dsall = self._open_from_memory(bucket_name, object_key)
+            else:
+                # Download the file from S3, unless this version of
+                # it is still in the local cache
+                local_file_path = get_local_cache().get_file(bucket_name, object_key,
+                                                             self.etag)
 
-            # Open the downloaded file with xarray
-            self.dsall = xr.open_dataset(local_file_path)
+                # Open the downloaded file with xarray
+                self.dsall = xr.open_dataset(local_file_path, cache=not self.chunk_size)
 
-            good = [flag in self.qc_keep for flag in self.dsall.QC_FLAG.values]
-            self.ds = self.dsall.where(good).dropna(dim='DATETIME')
+            self.dsall = self._select_variables(self.dsall)
+            if self.chunk_size:
+                self._read_chunks()
+            else:
+                self.ds = self._select_rows(self.dsall, np.flatnonzero(self._good_mask()))
             #self.logger.error(f'In readers.py: self.ds contents: {self.ds}')
         except Exception as exc:
             self.logger.error(
                 'Could not read file {} due to {}'.format(self.filename, exc))
             raise exc
 
+    def _read_chunks(self):
+        """
+        chunk_size mode: one pass over dsall.  Every chunk is decoded
+        once, and its csv rows, QC mask, compacted good rows and summary
+        are all made from that one copy before the next is read.
+        """
+        self.logger.error('In readers.py: _read_chunks')
+        if self.save_csv:
+            self._csv_out = self._start_csv()
+        summary = DeploymentSummary(logger=self.logger)
+        categories = []
+        parts = []
+        n_rows = self.dsall.sizes['DATETIME']
+        # at least one, possibly empty, chunk so ds keeps its variables
+        for start in range(0, max(n_rows, 1), self.chunk_size):
+            chunk = self.dsall.isel(DATETIME=slice(start, start + self.chunk_size)).load()
+            if self._csv_out is not None:
+                for csv_start in range(0, chunk.sizes['DATETIME'], self.csv_chunk_size):
+                    self._write_csv_rows(self._csv_out, self._csv_frame(chunk.isel(
+                        DATETIME=slice(csv_start, csv_start + self.csv_chunk_size))))
+            part = self._select_rows(chunk, np.flatnonzero(self._good_mask_of(chunk)),
+                                     categories)
+            summary.add(part)
+            parts.append(part)
+            del chunk
+        self.ds = xr.concat(parts, dim='DATETIME', data_vars='minimal', coords='minimal',
+                            compat='override', combine_attrs='override')
+        del parts
+        if 'PHASE' in self.ds and 'categories' in self.ds['PHASE'].attrs:
+            self.ds['PHASE'].attrs['categories'] = list(categories)
+        self.summary = summary.finish()
+
+    @staticmethod
+    def _csv_frame(chunk):
+        """
+        The csv rows of a slice of dsall as a dataframe.  Times are
+        formatted for the whole slice in one numpy call.
+        """
+        precision_values = {'LATITUDE': 6,
+                            'LONGITUDE': 6, 'DEPTH': 1, 'TEMPERATURE': 2}
+        data = {'DATETIME [UTC]': np.datetime_as_string(
+            chunk['DATETIME'].values, unit='s')}
+        for name, col_name in CSV_COLUMNS.items():
+            values = chunk[name].values
+            if name in precision_values:
+                values = np.round(values, decimals=precision_values[name])
+            data[col_name] = values
+        return(pd.DataFrame(data))
+
+    def _iter_csv_chunks(self):
+        """
+        Yields the csv rows of dsall as dataframes of at most
+        csv_chunk_size rows, so the full table is never built at once.
+        """
+        n_rows = self.dsall.sizes['DATETIME']
+        for start in range(0, n_rows, self.csv_chunk_size):
+            yield self._csv_frame(self.dsall.isel(
+                DATETIME=slice(start, start + self.csv_chunk_size)))
+
+    @staticmethod
+    def _start_csv():
+        """
+        Spooled temporary file for the csv, with the column names
+        already written, so a file without data still gets them
+        """
+        csv_out = tempfile.SpooledTemporaryFile(max_size=CSV_SPOOL_BYTES)
+        csv_out.write((','.join(['DATETIME [UTC]'] + list(CSV_COLUMNS.values()))
+                       + '\n').encode('utf-8'))
+        return(csv_out)
+
+    @staticmethod
+    def _write_csv_rows(csv_out, df):
+        csv_out.write(df.to_csv(header=False, index=False).encode('utf-8'))
+
     def _save_ds_as_csv(self):
         """
         Kind of a strange place to put this, but it's
@@ -83,16 +426,6 @@ class MangopareNetCDFReader(object):
                            'Moana calibration date', 'Moana Battery',
                            'Date quality controlled', 'Vessel Name', 'Vessel ID',
                            'Cellular upload position', 'Deck unit battery voltage']
-        precision_values = {'LATITUDE': 6,
-                            'LONGITUDE': 6, 'DEPTH': 1, 'TEMPERATURE': 2}
-        df2 = self.dsall.to_dataframe()[
-                                      ['LATITUDE', 'LONGITUDE', 'TEMPERATURE', 'DEPTH', 'QC_FLAG']].reset_index().copy()
-        df2['DATETIME'] = [t.strftime('%Y-%m-%dT%H:%M:%S')
-                           for t in df2.DATETIME]
-        for name, prec in precision_values.items():
-            df2[name] = df2[name].round(decimals=prec)
-        df2 = df2.rename(columns={
-                         'TEMPERATURE': 'TEMPERATURE [degC]', 'DEPTH': 'DEPTH [m]', 'DATETIME': 'DATETIME [UTC]'})
         # create csv header
         header_string = []
         for name in csv_header_keys:
@@ -113,22 +446,27 @@ class MangopareNetCDFReader(object):
         
         self.logger.error(f'In readers.py: Moana number: {moana_serial_number}')
         
-        # Define CSV file path in /tmp directory
         csv_filename = os.path.splitext(os.path.basename(self.filename))[0] + '.csv'
-        csv_file_path = '/tmp/' + csv_filename
-        
-        # Save DataFrame to CSV file in /tmp directory
-        df2.to_csv(csv_file_path, header=True, index=False)
-    
-        # Initialize S3 client
-        s3 = boto3.client('s3')
-    
-        # Upload CSV file to S3 bucket under the appropriate folder
-        s3_bucket_name = 'fishsoop-email'
-        s3_key = f'{moana_serial_number}/{csv_filename}'
-        s3.upload_file(csv_file_path, s3_bucket_name, s3_key)
-       
-        return(csv_filename)
+
+        # Write the csv chunk by chunk into a spooled temporary file,
+        # unless _read_chunks has already written it
+        csv_out, self._csv_out = self._csv_out, None
+        if csv_out is None:
+            csv_out = self._start_csv()
+            try:
+                for df in self._iter_csv_chunks():
+                    self._write_csv_rows(csv_out, df)
+            except Exception as exc:
+                csv_out.close()
+                raise exc
+
+        # Archive the CSV in the S3 bucket under the appropriate folder,
+        # in the background while the plot is made and the email sent
+        csv_file = Artifact(csv_filename, csv_out, 'text/csv',
+                            bucket_name='fishsoop-email',
+                            key=f'{moana_serial_number}/{csv_filename}',
+                            logger=self.logger)
+        return(csv_file.archive())
         
     def run(self):
         # read file based on self.filetype
@@ -145,4 +483,5 @@ class MangopareNetCDFReader(object):
         except Exception as exc:
             self.logger.error(
                 f'Could not read or save csv for {self.filename}')
+            self.close()
             return(None, [None])
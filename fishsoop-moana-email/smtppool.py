@@ -0,0 +1,198 @@
+import os
+import queue
+import logging
+import smtplib
+import threading
+import socketserver
+
+SMTP_SERVER = os.environ.get('SMTP_SERVER', 'SERVER')
+SMTP_PORT = int(os.environ.get('SMTP_PORT', 587))
+SMTP_USERNAME = os.environ.get('SMTP_USERNAME', 'username')
+SMTP_PASSWORD = os.environ.get('SMTP_PASSWORD', 'password')
+
+
+class SMTPPool(object):
+    """
+    Pool of logged-in SMTP sessions shared by every email of a
+    SendDataWrapper.run batch, so starttls() and login() are paid once
+    per connection rather than once per email.  At most max_connections
+    emails are sent at the same time; a session the server has dropped
+    is replaced and the email retried.
+    Input:
+        host, port, username, password: SMTP server and credentials
+        max_connections: number of concurrent sessions
+        use_tls: whether to call starttls() after connecting
+        timeout: socket timeout in seconds
+        retries: how many times to reconnect and resend after the
+        server drops a session
+    Usage:
+        with SMTPPool() as pool:
+            pool.sendmail(from_addr, to_addrs, msg.as_string())
+    """
+
+    def __init__(self,
+                 host=SMTP_SERVER,
+                 port=SMTP_PORT,
+                 username=SMTP_USERNAME,
+                 password=SMTP_PASSWORD,
+                 max_connections=4,
+                 use_tls=True,
+                 timeout=30,
+                 retries=2,
+                 logger=logging):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_tls = use_tls
+        self.timeout = timeout
+        self.retries = retries
+        self.logger = logger
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_connections)
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _connect(self):
+        self.logger.error(f'In smtppool.py: connecting to {self.host}:{self.port}')
+        server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            if self.use_tls:
+                server.starttls()
+            if self.username:
+                server.login(self.username, self.password)
+        except Exception:
+            server.close()
+            raise
+        return(server)
+
+    def _get(self):
+        try:
+            return(self._idle.get_nowait())
+        except queue.Empty:
+            return(self._connect())
+
+    @staticmethod
+    def _dropped(exc):
+        """
+        True if exc means the session is gone rather than the email was refused
+        """
+        if isinstance(exc, smtplib.SMTPResponseException):
+            return(exc.smtp_code == 421)
+        return(isinstance(exc, (smtplib.SMTPServerDisconnected, ConnectionError, TimeoutError)))
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        with self._slots:
+            server = self._get()
+            for attempt in range(self.retries + 1):
+                try:
+                    refused = server.sendmail(from_addr, to_addrs, msg)
+                    self._idle.put(server)
+                    return(refused)
+                except Exception as exc:
+                    server.close()
+                    if not self._dropped(exc) or attempt == self.retries:
+                        raise
+                    self.logger.error(f'In smtppool.py: session dropped ({exc}), reconnecting')
+                    server = self._connect()
+
+    def close(self):
+        while True:
+            try:
+                server = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                server.quit()
+            except Exception:
+                server.close()
+
+
+class _LocalSMTPHandler(socketserver.StreamRequestHandler):
+
+    def _reply(self, line):
+        self.wfile.write(f'{line}\r\n'.encode('utf-8'))
+
+    def handle(self):
+        generation = self.server.generation
+        mail_from, rcpt_tos = None, []
+        self._reply('220 localhost stand-in SMTP')
+        for raw in self.rfile:
+            if self.server.generation != generation:
+                # drop_connections() was called, hang up like a server would
+                return
+            line = raw.decode('utf-8').rstrip('\r\n')
+            command = line[:4].upper()
+            if command == 'EHLO':
+                self._reply('250-localhost')
+                self._reply('250 AUTH PLAIN LOGIN')
+            elif command == 'HELO':
+                self._reply('250 localhost')
+            elif command == 'AUTH':
+                self.server.logins += 1
+                self._reply('235 Authentication successful')
+            elif command == 'MAIL':
+                mail_from, rcpt_tos = line.split(':', 1)[1].strip(), []
+                self._reply('250 OK')
+            elif command == 'RCPT':
+                rcpt_tos.append(line.split(':', 1)[1].strip())
+                self._reply('250 OK')
+            elif command == 'DATA':
+                self._reply('354 End data with <CR><LF>.<CR><LF>')
+                data = []
+                for data_line in self.rfile:
+                    if data_line in (b'.\r\n', b'.\n'):
+                        break
+                    data.append(data_line)
+                with self.server.lock:
+                    self.server.messages.append((mail_from, rcpt_tos, b''.join(data)))
+                self._reply('250 OK')
+            elif command in ('RSET', 'NOOP'):
+                self._reply('250 OK')
+            elif command == 'QUIT':
+                self._reply('221 Bye')
+                return
+            else:
+                self._reply('502 Command not implemented')
+
+
+class LocalSMTPServer(socketserver.ThreadingTCPServer):
+    """
+    Minimal SMTP stand-in for tests.  Runs in a background thread on
+    localhost, accepts any login and keeps every message it receives in
+    messages as (mail_from, rcpt_tos, data).  It does not speak TLS, so
+    use SMTPPool(use_tls=False) with it.
+    Usage:
+        with LocalSMTPServer() as server:
+            pool = SMTPPool(host=server.host, port=server.port, use_tls=False)
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=0):
+        super().__init__((host, port), _LocalSMTPHandler)
+        self.host, self.port = self.server_address
+        self.messages = []
+        self.logins = 0
+        self.generation = 0
+        self.lock = threading.Lock()
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return(self)
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+
+    def drop_connections(self):
+        """
+        Make every open session hang up on its next command
+        """
+        self.generation += 1
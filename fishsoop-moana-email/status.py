@@ -0,0 +1,431 @@
+import io
+import sys
+import json
+import time
+import uuid
+import argparse
+import datetime
+import logging
+import threading
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError, ParamValidationError
+from ops_mangopare.aws import get_s3_client, split_s3_path
+
+# Names known to have been emailed by this process.  Sent is final, so
+# these can be kept for the lifetime of a warm container.
+_SENT_CACHE = set()
+_SENT_CACHE_LOCK = threading.Lock()
+
+# Input files this process has finished or claimed recently, id -> time
+# seen, so a repeated delivery of the same event costs nothing
+_RECENT_INPUTS = {}
+_RECENT_INPUTS_TTL = 300
+
+# Input claims and compaction locks are conditional puts (IfNoneMatch),
+# which need boto3/botocore 1.35 (August 2024) or later; deploy the
+# Lambda with at least that version rather than the runtime's bundled
+# SDK.  Older versions reject the parameter with ParamValidationError:
+# files are then processed without a claim, and compaction is skipped.
+MIN_BOTOCORE = '1.35'
+_CONDITIONAL_PUT_WARNED = False
+
+
+def _warn_no_conditional_put(logger, exc):
+    global _CONDITIONAL_PUT_WARNED
+    if not _CONDITIONAL_PUT_WARNED:
+        _CONDITIONAL_PUT_WARNED = True
+        logger.warning(f'In status.py: conditional puts need botocore {MIN_BOTOCORE} '
+                       f'or later ({exc}), running without claims or compaction locks')
+
+
+class SentLedger(object):
+    """
+    Record of every attachment and plot that has been emailed, kept as
+    one empty marker object per name under prefix.  Checking a name is a
+    single HEAD request, no matter how many emails have been sent.
+    The ledger replaces scanning the full status csv for duplicates; use
+    import_status_file (or `python status.py import <status csv>`) once
+    to load the history from an existing status csv.
+    The ledger also tracks input files, keyed on their S3 key and ETag,
+    so a file that was already emailed, or is being processed right now
+    by another invocation, can be skipped before it is even read:
+    claim_input takes a claim with a conditional put, mark_input_done
+    replaces it with a permanent marker, and release_input drops it
+    after a failure so the file can be tried again.
+    Input:
+        prefix: s3:// path under which the markers are stored
+        claim_ttl: seconds after which a claim is assumed to belong to
+        an invocation that died, and can be taken over
+    """
+
+    ready_marker = '_imported'
+
+    def __init__(self,
+                 prefix='s3://fishsoop-email/sent_ledger/',
+                 claim_ttl=900,
+                 logger=logging):
+        self.bucket_name, self.prefix = split_s3_path(prefix.rstrip('/') + '/')
+        self.claim_ttl = claim_ttl
+        self.logger = logger
+        self.s3_client = get_s3_client()
+        self._ready = None
+
+    def _marker_key(self, name):
+        return(f'{self.prefix}{name}')
+
+    def _exists(self, key):
+        try:
+            self.s3_client.head_object(Bucket=self.bucket_name, Key=key)
+            return(True)
+        except ClientError as exc:
+            if exc.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                return(False)
+            raise exc
+
+    def is_ready(self):
+        """
+        True once the status csv history has been imported, so that a
+        missing marker really means the name has not been sent
+        """
+        if not self._ready:
+            self._ready = self._exists(self._marker_key(self.ready_marker))
+        return(self._ready)
+
+    def has_been_sent(self, name):
+        if name in _SENT_CACHE:
+            return(True)
+        sent = self._exists(self._marker_key(name))
+        if sent:
+            with _SENT_CACHE_LOCK:
+                _SENT_CACHE.add(name)
+        return(sent)
+
+    def any_sent(self, names):
+        return(any(self.has_been_sent(name) for name in names if name))
+
+    def mark_sent(self, name, metadata={}):
+        self.s3_client.put_object(Bucket=self.bucket_name,
+                                  Key=self._marker_key(name), Body=b'',
+                                  Metadata={k: str(v) for k, v in metadata.items()})
+        with _SENT_CACHE_LOCK:
+            _SENT_CACHE.add(name)
+
+    @staticmethod
+    def input_id(key, etag):
+        etag = etag.strip('"')
+        return(f'{key}@{etag}')
+
+    def _input_key(self, input_id, kind):
+        return(f'{self.prefix}_inputs/{kind}/{input_id}')
+
+    @staticmethod
+    def seen_recently(input_id):
+        """
+        True if this process finished or claimed input_id in the last
+        few minutes, i.e. this is a duplicate delivery of an event.
+        Only checks; ids are recorded by _note_input once a claim or
+        done marker has actually been seen or written.
+        """
+        now = time.time()
+        with _SENT_CACHE_LOCK:
+            for old_id in [i for i, t in _RECENT_INPUTS.items() if now - t > _RECENT_INPUTS_TTL]:
+                del _RECENT_INPUTS[old_id]
+            return(input_id in _RECENT_INPUTS)
+
+    @staticmethod
+    def _note_input(input_id):
+        with _SENT_CACHE_LOCK:
+            _RECENT_INPUTS[input_id] = time.time()
+
+    def input_done(self, input_id):
+        done = self._exists(self._input_key(input_id, 'done'))
+        if done:
+            self._note_input(input_id)
+        return(done)
+
+    def claim_input(self, input_id):
+        """
+        Claim input_id for this invocation.  Returns False if another
+        invocation holds a claim younger than claim_ttl.  Returns True
+        without a claim if botocore is too old for conditional puts
+        (see MIN_BOTOCORE).
+        """
+        key = self._input_key(input_id, 'claims')
+        for _ in range(2):
+            try:
+                self.s3_client.put_object(Bucket=self.bucket_name, Key=key, Body=b'',
+                                          IfNoneMatch='*')
+                self._note_input(input_id)
+                return(True)
+            except ParamValidationError as exc:
+                _warn_no_conditional_put(self.logger, exc)
+                return(True)
+            except ClientError as exc:
+                if exc.response['Error']['Code'] not in ('PreconditionFailed', '412'):
+                    raise exc
+            try:
+                head = self.s3_client.head_object(Bucket=self.bucket_name, Key=key)
+            except ClientError:
+                # released in the meantime, try again
+                continue
+            age = time.time() - head['LastModified'].timestamp()
+            if age < self.claim_ttl:
+                return(False)
+            self.logger.error(f'In status.py: taking over stale claim on {input_id}')
+            self.s3_client.delete_object(Bucket=self.bucket_name, Key=key)
+        return(False)
+
+    def release_input(self, input_id):
+        self.s3_client.delete_object(Bucket=self.bucket_name,
+                                     Key=self._input_key(input_id, 'claims'))
+        with _SENT_CACHE_LOCK:
+            _RECENT_INPUTS.pop(input_id, None)
+
+    def mark_input_done(self, input_id):
+        self.s3_client.put_object(Bucket=self.bucket_name,
+                                  Key=self._input_key(input_id, 'done'), Body=b'')
+        self.s3_client.delete_object(Bucket=self.bucket_name,
+                                     Key=self._input_key(input_id, 'claims'))
+        self._note_input(input_id)
+
+    def import_status_file(self, status_file, max_workers=16):
+        """
+        Create markers for every attachment and plot listed in an
+        existing status csv, then flag the ledger as ready.  Safe to
+        run more than once.
+        """
+        self.logger.error(f'In status.py: importing {status_file}')
+        bucket_name, object_key = split_s3_path(status_file)
+        response = self.s3_client.get_object(Bucket=bucket_name, Key=object_key)
+        df = pd.read_csv(io.BytesIO(response['Body'].read()))
+        names = set()
+        for column in ['Attachments', 'Plots']:
+            for cell in df[column].dropna().astype(str):
+                names.update(name.strip() for name in cell.split(','))
+        names.discard('')
+        names.discard('None')
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(self.mark_sent, sorted(names)))
+        self.mark_sent(self.ready_marker, {'source': status_file})
+        self._ready = True
+        self.logger.error(f'In status.py: imported {len(names)} names into the ledger')
+        return(len(names))
+
+
+class StatusLog(object):
+    """
+    Append-only log of sent emails.  Every send writes its own small csv
+    segment under segments/<YYYY>/<MM>/<DD>/<HH>/, so the cost of a write
+    does not depend on the size of the history and concurrent senders
+    cannot overwrite each other.  compact() merges the segments of
+    finished hours into one csv per hour under compacted/, and read()
+    returns the same table the old status csv held.  Each hour is
+    compacted under a lock, a marker under compacting/ taken with a
+    conditional put, so overlapping compactions do not merge the same
+    segments twice.
+    Input:
+        prefix: s3:// path under which segments and compacted files are kept
+        legacy_file: the old single status csv, included by read() so
+        history from before the log existed is not lost
+    sent_names() reads the log once per StatusLog, so share one across
+    the emails of a run.
+    """
+
+    columns = ['Datetime', 'Recipients', 'Attachments', 'Plots', 'BCC', 'From', 'Replyto']
+
+    def __init__(self,
+                 prefix='s3://fishsoop-email/status_log/',
+                 legacy_file='s3://fishsoop-email/fishsoop_emails_sent.csv',
+                 logger=logging):
+        self.bucket_name, self.prefix = split_s3_path(prefix.rstrip('/') + '/')
+        self.legacy_file = legacy_file
+        self.logger = logger
+        self.s3_client = get_s3_client()
+        self._sent = None
+        self._sent_lock = threading.Lock()
+
+    def _list_keys(self, prefix):
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                yield obj['Key']
+
+    def _read_csv(self, bucket_name, key):
+        response = self.s3_client.get_object(Bucket=bucket_name, Key=key)
+        return(pd.read_csv(io.BytesIO(response['Body'].read())))
+
+    def append(self, row):
+        """
+        Write one row (dict keyed by columns) as its own segment
+        """
+        now = datetime.datetime.utcnow()
+        key = (f'{self.prefix}segments/{now:%Y/%m/%d/%H}/'
+               f'{now:%Y%m%dT%H%M%S%f}-{uuid.uuid4().hex}.csv')
+        body = pd.DataFrame([row], columns=self.columns).to_csv(index=False)
+        self.s3_client.put_object(Bucket=self.bucket_name, Key=key,
+                                  Body=body.encode('utf-8'))
+        with self._sent_lock:
+            if self._sent is not None:
+                for column, names in self._sent.items():
+                    names.add(row.get(column))
+        return(key)
+
+    def sent_names(self):
+        """
+        The Attachments and Plots cells of read() as sets, keyed by
+        column.  The log is read the first time only and append() keeps
+        the sets up to date, so checking every email of a run for
+        duplicates costs a single read.
+        """
+        with self._sent_lock:
+            if self._sent is None:
+                df = self.read()
+                self._sent = {column: set(df[column].to_list())
+                              for column in ('Attachments', 'Plots')}
+            return(self._sent)
+
+    def _lock_hour(self, marker_key, lock_ttl):
+        """
+        Take the compaction marker of an hour.  Returns (locked,
+        merged), merged being the segments that a compaction which
+        died had already merged but not yet deleted; a marker older
+        than lock_ttl is assumed to belong to such a compaction and is
+        taken over.  Never locked if botocore is too old for conditional
+        puts (see MIN_BOTOCORE), since merging without a lock could
+        merge segments twice.
+        """
+        merged = []
+        for _ in range(2):
+            try:
+                self.s3_client.put_object(Bucket=self.bucket_name, Key=marker_key,
+                                          Body=json.dumps({'merged': merged}).encode('utf-8'),
+                                          IfNoneMatch='*')
+                return(True, merged)
+            except ParamValidationError as exc:
+                _warn_no_conditional_put(self.logger, exc)
+                return(False, [])
+            except ClientError as exc:
+                if exc.response['Error']['Code'] not in ('PreconditionFailed', '412'):
+                    raise exc
+            try:
+                response = self.s3_client.get_object(Bucket=self.bucket_name, Key=marker_key)
+            except ClientError:
+                # released in the meantime, try again
+                continue
+            age = time.time() - response['LastModified'].timestamp()
+            if age < lock_ttl:
+                return(False, [])
+            merged = json.loads(response['Body'].read()).get('merged', [])
+            self.logger.error(f'In status.py: taking over stale compaction of {marker_key}')
+            self.s3_client.delete_object(Bucket=self.bucket_name, Key=marker_key)
+        return(False, [])
+
+    def compact(self, grace_hours=1, lock_ttl=900):
+        """
+        Merge the segments of every hour that finished more than
+        grace_hours ago into compacted/<YYYY>/<MM>/<DD>/<HH>.csv and
+        delete them.  Segments that arrive late for an hour that was
+        already compacted are merged into the existing file.  Hours
+        another compaction is working on (marker younger than
+        lock_ttl seconds) are left alone.
+        """
+        self.logger.error('In status.py: compact')
+        cutoff = (datetime.datetime.utcnow()
+                  - datetime.timedelta(hours=grace_hours)).strftime('%Y/%m/%d/%H')
+        seg_prefix = f'{self.prefix}segments/'
+        hours = {}
+        for key in self._list_keys(seg_prefix):
+            hour = key[len(seg_prefix):].rsplit('/', 1)[0]
+            if hour < cutoff:
+                hours.setdefault(hour, []).append(key)
+        n_hours = 0
+        for hour, keys in sorted(hours.items()):
+            out_key = f'{self.prefix}compacted/{hour}.csv'
+            marker_key = f'{self.prefix}compacting/{hour}.json'
+            locked, merged = self._lock_hour(marker_key, lock_ttl)
+            if not locked:
+                self.logger.error(f'In status.py: {hour} is being compacted elsewhere, skipping')
+                continue
+            # listed again under the lock: a compaction that just
+            # finished may have deleted some of them
+            keys = list(self._list_keys(f'{seg_prefix}{hour}/'))
+            new_keys = sorted(set(keys) - set(merged))
+            try:
+                if new_keys:
+                    frames = []
+                    try:
+                        frames.append(self._read_csv(self.bucket_name, out_key))
+                    except ClientError as exc:
+                        if exc.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+                            raise exc
+                    frames.extend(self._read_csv(self.bucket_name, key) for key in new_keys)
+                    df = pd.concat(frames, ignore_index=True)[self.columns]
+                    self.s3_client.put_object(Bucket=self.bucket_name, Key=out_key,
+                                              Body=df.to_csv(index=False).encode('utf-8'))
+            except Exception as exc:
+                # nothing merged, let the next compaction do it
+                self.s3_client.delete_object(Bucket=self.bucket_name, Key=marker_key)
+                raise exc
+            # record what is merged before deleting it, so a compaction
+            # that dies while deleting never merges these segments again
+            keys = sorted(set(keys) | set(merged))
+            self.s3_client.put_object(Bucket=self.bucket_name, Key=marker_key,
+                                      Body=json.dumps({'merged': keys}).encode('utf-8'))
+            for start in range(0, len(keys), 1000):
+                self.s3_client.delete_objects(
+                    Bucket=self.bucket_name,
+                    Delete={'Objects': [{'Key': key} for key in keys[start:start + 1000]],
+                            'Quiet': True})
+            self.s3_client.delete_object(Bucket=self.bucket_name, Key=marker_key)
+            self.logger.error(f'In status.py: compacted {len(new_keys)} segments into {out_key}')
+            n_hours += 1
+        return(n_hours)
+
+    def read(self):
+        """
+        Returns every recorded send as one dataframe with the columns
+        of the old status csv: legacy file first, then compacted hours
+        and any segments not compacted yet, oldest first
+        """
+        self.logger.error('In status.py: read')
+        frames = []
+        if self.legacy_file:
+            bucket_name, object_key = split_s3_path(self.legacy_file)
+            try:
+                frames.append(self._read_csv(bucket_name, object_key))
+            except ClientError as exc:
+                if exc.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+                    raise exc
+        for sub_prefix in ['compacted/', 'segments/']:
+            keys = sorted(self._list_keys(f'{self.prefix}{sub_prefix}'))
+            frames.extend(self._read_csv(self.bucket_name, key) for key in keys)
+        if not frames:
+            return(pd.DataFrame(columns=self.columns))
+        return(pd.concat(frames, ignore_index=True)[self.columns])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Maintenance of the sent ledger and the emails sent status log')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    import_parser = subparsers.add_parser(
+        'import', help='Import an existing emails sent status csv into the sent ledger')
+    import_parser.add_argument('status_file',
+                               help='s3:// path of the status csv, e.g. s3://fishsoop-email/fishsoop_emails_sent.csv')
+    import_parser.add_argument('--prefix', default='s3://fishsoop-email/sent_ledger/',
+                               help='s3:// path of the ledger markers')
+    compact_parser = subparsers.add_parser(
+        'compact', help='Merge status log segments of finished hours')
+    compact_parser.add_argument('--prefix', default='s3://fishsoop-email/status_log/',
+                                help='s3:// path of the status log')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    if args.command == 'import':
+        SentLedger(prefix=args.prefix).import_status_file(args.status_file)
+    else:
+        StatusLog(prefix=args.prefix).compact()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,194 @@
+import logging
+import numpy as np
+
+
+def phase_mask(phase, code='D'):
+    """
+    PHASE == code, for PHASE (a DataArray) stored as int8 codes with a
+    'categories' attribute (readers.py compact_dtypes) or as str, bytes
+    or char arrays, without converting the whole array to str
+    """
+    categories = phase.attrs.get('categories')
+    phase = np.asarray(phase.values)
+    if categories is not None:
+        if code not in list(categories):
+            return(np.zeros(phase.shape, dtype=bool))
+        return(phase == list(categories).index(code))
+    if phase.dtype.kind == 'S':
+        return(phase == code.encode('utf-8'))
+    if phase.dtype.kind == 'U':
+        return(phase == code)
+    return(phase.astype(str) == code)
+
+
+class _Extremes(object):
+    """
+    Running min, max and mean of an array seen in pieces, with the
+    positions of min and max in the whole array.  NaN (and position
+    None) until a valid value has been seen.
+    """
+
+    def __init__(self):
+        self.min = self.max = np.nan
+        self.i_min = self.i_max = None
+        self.sum = 0.
+        self.count = 0
+
+    def update(self, values, offset=0):
+        values = np.asarray(values)
+        n_valid = int(np.count_nonzero(np.isfinite(values)))
+        if n_valid == 0:
+            return
+        i_min = int(np.nanargmin(values))
+        i_max = int(np.nanargmax(values))
+        if self.i_min is None or values[i_min] < self.min:
+            self.min, self.i_min = values[i_min], offset + i_min
+        if self.i_max is None or values[i_max] > self.max:
+            self.max, self.i_max = values[i_max], offset + i_max
+        self.sum += float(np.nansum(values, dtype=np.float64))
+        self.count += n_valid
+
+    @property
+    def mean(self):
+        return(self.sum / self.count if self.count else np.nan)
+
+
+class DeploymentSummary(object):
+    """
+    The numbers the plot and the email need from a deployment, worked
+    out once after the file is read, so that PlotMangopare and
+    MangopareMailer do not each make their own passes (and copies) over
+    the arrays.
+    Input:
+        ds: xarray dataset from ops_mangopare/readers.py, already QC
+        filtered.  None for a summary built up chunk by chunk with
+        add(), then finish().
+        bottom_phase: PHASE value of measurements at fishing depth
+        chunk_size: go through ds this many samples at a time, so a lazy
+        dataset is never loaded whole.  None for one pass over the full
+        arrays.
+    Attributes:
+        n: number of measurements
+        time_min, time_max: time range (numpy datetime64)
+        temp_min, temp_max, temp_mean, i_temp_min, i_temp_max:
+        temperature extremes and mean, and where the extremes are
+        depth_min, depth_max, depth_mean, depth_at_temp_min,
+        depth_at_temp_max: depth range and mean, and the depth of the
+        temperature extremes
+        bottom_temp_min, bottom_temp_max, bottom_temp_mean,
+        bottom_depth_mean: the same for the bottom (fishing) phase only,
+        or for all measurements if there is no bottom phase
+        lat_min, lat_max, lon_min, lon_max: position extent
+        lon360_min, lon360_max: longitude extent in 0-360, for maps
+        crossing the dateline
+    """
+
+    def __init__(self, ds=None, bottom_phase='D', chunk_size=None, logger=logging):
+        # no logger kept, so the summary can be sent to plot processes
+        logger.error('In summary.py: DeploymentSummary')
+        self.n = 0
+        self.time_min = self.time_max = None
+        self.depth_at_temp_min = self.depth_at_temp_max = np.nan
+        # running state, dropped by finish() so it never ends up in to_dict()
+        self._state = {'bottom_phase': bottom_phase,
+                       'temp': _Extremes(), 'depth': _Extremes(),
+                       'lat': _Extremes(), 'lon': _Extremes(), 'lon360': _Extremes(),
+                       'bottom_temp': _Extremes(), 'bottom_depth': _Extremes()}
+        if ds is None:
+            return
+        n = ds.sizes['DATETIME']
+        if not chunk_size:
+            chunk_size = max(n, 1)
+        for start in range(0, n, chunk_size):
+            self.add(ds.isel(DATETIME=slice(start, start + chunk_size)) if chunk_size < n else ds)
+        self.finish()
+
+    def add(self, chunk):
+        """
+        Add the next samples (along DATETIME) of the deployment
+        """
+        state = self._state
+        start = self.n
+        n = chunk.sizes['DATETIME']
+        if n == 0:
+            return
+        # in whatever dtype the reader kept them, no upcast copies
+        times = chunk['DATETIME'].values
+        t_chunk = chunk['TEMPERATURE'].values
+        d_chunk = chunk['DEPTH'].values
+        lon_chunk = chunk['LONGITUDE'].values
+
+        t_min, t_max = np.nanmin(times), np.nanmax(times)
+        if self.time_min is None or t_min < self.time_min:
+            self.time_min = t_min
+        if self.time_max is None or t_max > self.time_max:
+            self.time_max = t_max
+
+        temp = state['temp']
+        i_min, i_max = temp.i_min, temp.i_max
+        temp.update(t_chunk, start)
+        if temp.i_min != i_min:
+            self.depth_at_temp_min = d_chunk[temp.i_min - start]
+        if temp.i_max != i_max:
+            self.depth_at_temp_max = d_chunk[temp.i_max - start]
+        state['depth'].update(d_chunk)
+        state['lat'].update(chunk['LATITUDE'].values)
+        state['lon'].update(lon_chunk)
+        state['lon360'].update(lon_chunk % 360)
+
+        if 'PHASE' in chunk.variables:
+            bottom = phase_mask(chunk['PHASE'], state['bottom_phase'])
+            state['bottom_temp'].update(t_chunk[bottom])
+            state['bottom_depth'].update(d_chunk[bottom])
+        self.n += n
+
+    def finish(self):
+        """
+        Work out the attributes once every chunk has been added.
+        Returns the summary.
+        """
+        state = self._state
+        del self._state
+        temp, depth = state['temp'], state['depth']
+        self.temp_min, self.temp_max, self.temp_mean = temp.min, temp.max, temp.mean
+        self.i_temp_min, self.i_temp_max = temp.i_min, temp.i_max
+        self.depth_min, self.depth_max, self.depth_mean = depth.min, depth.max, depth.mean
+
+        # if there are no bottom data, then use all measurements in
+        # the deployment
+        bottom_temp, bottom_depth = state['bottom_temp'], state['bottom_depth']
+        if not bottom_temp.count:
+            bottom_temp, bottom_depth = temp, depth
+        self.bottom_temp_min, self.bottom_temp_max = bottom_temp.min, bottom_temp.max
+        self.bottom_temp_mean = bottom_temp.mean
+        self.bottom_depth_mean = bottom_depth.mean
+
+        self.lat_min, self.lat_max = state['lat'].min, state['lat'].max
+        self.lon_min, self.lon_max = state['lon'].min, state['lon'].max
+        self.lon360_min, self.lon360_max = state['lon360'].min, state['lon360'].max
+        return(self)
+
+    @classmethod
+    def from_dict(cls, values):
+        """
+        Rebuild a summary from to_dict() output
+        """
+        summary = cls.__new__(cls)
+        for name, value in values.items():
+            if name in ('time_min', 'time_max') and value is not None:
+                value = np.datetime64(value)
+            setattr(summary, name, value)
+        return(summary)
+
+    def to_dict(self):
+        """
+        Plain values (times as ISO strings) for JSON, e.g. for web stats
+        """
+        out = {}
+        for name, value in vars(self).items():
+            if isinstance(value, np.datetime64):
+                value = str(value.astype('datetime64[s]'))
+            elif isinstance(value, np.generic):
+                value = value.item()
+            out[name] = value
+        return(out)
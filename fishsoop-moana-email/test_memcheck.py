@@ -0,0 +1,41 @@
+"""
+A short memcheck run as a test: files go through SendDataWrapper's read
+and plot stages and _finish with S3 replaced by memcheck.LocalS3Client,
+and nothing (figures, file descriptors, temporary files, readers) may
+be left behind.  Needs the full scientific stack, so it is skipped
+where numpy, xarray or matplotlib are not installed.
+
+Usage:
+    python -m pytest test_memcheck.py
+"""
+import logging
+import unittest
+import importlib.util
+
+LOGGER = logging.getLogger('test_memcheck')
+LOGGER.setLevel(logging.CRITICAL)
+
+# RSS growth allowed after the warm-up files
+MAX_GROWTH_MB = 5
+
+MISSING = [name for name in ('numpy', 'pandas', 'xarray', 'netCDF4', 'matplotlib', 'boto3')
+           if importlib.util.find_spec(name) is None]
+
+
+@unittest.skipIf(MISSING, f'needs {", ".join(MISSING)}')
+class MemcheckTest(unittest.TestCase):
+
+    def test_nothing_is_left_behind(self):
+        import memcheck
+        results = memcheck.check(n_files=12, n_samples=2000, fail_every=3,
+                                 warmup=0.5, logger=LOGGER)
+        # every third file is a failing one
+        self.assertEqual(results['ok'], 8)
+        self.assertEqual(results['failed'], 4)
+        self.assertGreater(results['uploads'], 0)
+        # resident memory stays flat once the warm-up files are done
+        self.assertEqual(memcheck.failures(results, max_growth_mb=MAX_GROWTH_MB), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
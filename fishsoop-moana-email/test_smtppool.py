@@ -0,0 +1,64 @@
+"""
+SMTPPool against LocalSMTPServer: sessions are reused across emails,
+and an email whose session the server dropped is resent on a new one.
+
+Usage:
+    python -m pytest test_smtppool.py
+"""
+import logging
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from testutils import add_package_path
+
+add_package_path()
+from ops_mangopare.smtppool import SMTPPool, LocalSMTPServer  # noqa: E402
+
+LOGGER = logging.getLogger('test_smtppool')
+LOGGER.setLevel(logging.CRITICAL)
+
+
+def _message(i):
+    return(f'Subject: test {i}\r\n\r\nbody {i}\r\n')
+
+
+class SMTPPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = LocalSMTPServer().__enter__()
+        self.pool = SMTPPool(host=self.server.host, port=self.server.port,
+                             username='user', password='secret', use_tls=False,
+                             max_connections=2, timeout=5, logger=LOGGER)
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.__exit__(None, None, None)
+
+    def _send(self, i):
+        return(self.pool.sendmail('from@example.com', [f'to{i}@example.com'], _message(i)))
+
+    def test_sessions_are_reused(self):
+        for i in range(5):
+            self.assertEqual(self._send(i), {})
+        self.assertEqual(len(self.server.messages), 5)
+        self.assertEqual(self.server.logins, 1)
+
+    def test_concurrent_sends_stay_within_max_connections(self):
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(self._send, range(12)))
+        self.assertEqual(len(self.server.messages), 12)
+        self.assertLessEqual(self.server.logins, 2)
+
+    def test_reconnects_after_server_drops_session(self):
+        self._send(0)
+        self.server.drop_connections()
+        self.assertEqual(self._send(1), {})
+        self.assertEqual(self.server.logins, 2)
+        rcpt_tos = [message[1] for message in self.server.messages]
+        self.assertEqual(rcpt_tos, [['<to0@example.com>'], ['<to1@example.com>']])
+        # the new session is kept for the next email
+        self._send(2)
+        self.assertEqual(self.server.logins, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+"""
+Helpers shared by the tests and the check scripts (test_*.py,
+memcheck.py, bench_imports.py).
+"""
+import os
+import sys
+import atexit
+import shutil
+import tempfile
+import threading
+
+_PACKAGE_PATH = None
+_PACKAGE_PATH_LOCK = threading.Lock()
+
+
+def package_path():
+    """
+    Directory to put on PYTHONPATH so ops_mangopare can be imported.
+    When run from a checkout the package is this directory, so it is
+    linked under its import name in a temporary directory, made once
+    per process and removed when the process exits.
+    """
+    global _PACKAGE_PATH
+    here = os.path.dirname(os.path.realpath(__file__))
+    if os.path.basename(here) == 'ops_mangopare':
+        return(os.path.dirname(here))
+    with _PACKAGE_PATH_LOCK:
+        if _PACKAGE_PATH is None:
+            tmp_dir = tempfile.mkdtemp(prefix='ops_mangopare_')
+            # rmtree removes the link, not the checkout it points to
+            atexit.register(shutil.rmtree, tmp_dir, ignore_errors=True)
+            os.symlink(here, os.path.join(tmp_dir, 'ops_mangopare'))
+            _PACKAGE_PATH = tmp_dir
+        return(_PACKAGE_PATH)
+
+
+def add_package_path():
+    """
+    Make ops_mangopare importable in this process
+    """
+    path = package_path()
+    if path not in sys.path:
+        sys.path.insert(0, path)
+    return(path)
@@ -1,9 +1,36 @@
+import os
 import re
+import time
+import queue
 import logging
-import boto3
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from ops_mangopare.utils import import_pycallable
-from ops_mangopare.plot import PlotMangopare
+from ops_mangopare.plot import PlotMangopare, plot_inputs, render_plot, render_params
 from ops_mangopare.mails import MangopareMailer
+from ops_mangopare.smtppool import SMTPPool
+from ops_mangopare.artifacts import Artifact
+from ops_mangopare.summary import DeploymentSummary
+from ops_mangopare.status import SentLedger, StatusLog
+from ops_mangopare.derived import DerivedStore
+from ops_mangopare.aws import get_s3_client, split_s3_path
+from botocore.exceptions import ClientError, BotoCoreError
+
+# matplotlib's pyplot state machine is not thread-safe, so only one
+# file at a time is allowed into the plot stage
+_PLOT_LOCK = threading.Lock()
+
+# Put on a stage queue to stop one worker of that stage
+_DONE = object()
+
+STAGES = ['read', 'plot', 'send']
+
+# Reader settings that change the csv or the dataset, part of the key of
+# derived artifacts
+READER_PARAMS = ['qc_keep', 'variables', 'compact_dtypes', 'save_csv', 'out_dir',
+                 'chunk_size']
 
 class SendDataWrapper(object):
     """
@@ -30,6 +57,19 @@ class SendDataWrapper(object):
         sent.  Filters sensors that were just splashed.
         create_status_file: if no status file already exists, create it (again,
         see mails.MangopareMailer)
+        ledger_prefix: s3:// location of the sent ledger (status.SentLedger).
+        Before a file is read, its key and ETag are checked there, and
+        files already emailed or being processed by another invocation
+        are skipped, as are repeated deliveries of the same event to
+        this container.  Not checked if ledger_prefix or status_file is
+        None (resend everything).
+        claim_ttl: seconds a claim on a file in progress is honoured, see
+        status.SentLedger
+        derived_prefix: s3:// location of the derived artifact store
+        (derived.DerivedStore).  A file seen before with the same ETag,
+        reader and plot settings and code gets its csv, plot and summary
+        from there, without being downloaded, decoded or plotted again.
+        None to always process files from scratch.
         logo_file: path and filename of logo to include in plot, if needed
         email_plot: whether to include the plot in the email
         email_raw_data: whether to include the processed csv in the email (a
@@ -40,10 +80,36 @@ class SendDataWrapper(object):
         plot design, if this is False, there will be an empty white space
         where the map would go.
         plot_data: whether to create a plot of the data
+        plot_max_points: point budget for the plot, see plot.PlotMangopare
+        (None plots every point)
+        plot_render_mode: 'scatter' or 'raster', see plot.PlotMangopare
+        plot_add_logo: draw the programme logo on the plot (off, as it
+        always has been)
+        plot_reuse_figure: keep one figure per process and only swap in
+        each file's data, see plot.PlotMangopare reuse_figure.  Changes
+        the layout of the png slightly (no tight bbox).
         datareader: python class to read the qc'd netCDF files
+        read_chunk_size: stream files from disk in one pass of this many
+        samples at a time (see readers.MangopareNetCDFReader
+        chunk_size).  None loads each file at once.
+        max_workers: number of files downloaded and read at the same time.
+        Files go through three stages, read, plot and send (email plus
+        waiting for the S3 uploads), joined by bounded queues, so while
+        one file is plotted the next ones are downloading and the
+        previous ones are being sent.  Plotting is done one file at a
+        time, unless plot_processes is set; max_smtp_connections files
+        are sent at once.
+        prefetch: files that can wait between two stages.  Bounds how
+        many datasets are held in memory.
+        plot_processes: render plots in a pool of worker processes
+        instead, so several plots are made at once.  True for one
+        worker per available core, or the number of workers.  Only the
+        arrays and attributes a plot needs are sent to the workers.  If
+        a process pool cannot be started (e.g. no /dev/shm in Lambda),
+        plots are made in-process as before.
     Output:
         Plots, csv files, and emails are created as specified.
-        Nothing is returned.
+        run() returns the list of files that were processed without error.
     """
 
     def __init__(self,
@@ -55,15 +121,27 @@ class SendDataWrapper(object):
                  status_file='s3://fishsoop-email/fishsoop_emails_sent.csv',
                  cutoff_num=5,
                  create_status_file=False,
+                 ledger_prefix='s3://fishsoop-email/sent_ledger/',
+                 claim_ttl=900,
+                 derived_prefix='s3://fishsoop-email/derived/',
                  logo_file='fsoop_logo.png',
                  email_plot=True,
                  email_raw_data=True,
                  plot_out_dir=False,
                  plot_add_map=True,
                  plot_data=True,
+                 plot_max_points=None,
+                 plot_render_mode='scatter',
+                 plot_add_logo=False,
+                 plot_reuse_figure=False,
                  datareader={},
                  logger=logging,
                  pipe=None,
+                 max_workers=4,
+                 max_smtp_connections=4,
+                 plot_processes=False,
+                 prefetch=2,
+                 read_chunk_size=None,
                  **kwargs):
 
         self.filelist = filelist
@@ -74,17 +152,36 @@ class SendDataWrapper(object):
         self.status_file = status_file
         self.cutoff_num = cutoff_num
         self.create_status_file = create_status_file
+        self.ledger = SentLedger(prefix=ledger_prefix, claim_ttl=claim_ttl,
+                                 logger=logger) if ledger_prefix and status_file else None
+        self.derived = DerivedStore(prefix=derived_prefix,
+                                    logger=logger) if derived_prefix else None
         self.logo_file = logo_file
         self.email_plot = email_plot
         self.email_raw_data = email_raw_data
         self.plot_out_dir = plot_out_dir
         self.plot_add_map = plot_add_map
+        self.plot_max_points = plot_max_points
+        self.plot_render_mode = plot_render_mode
+        self.plot_reuse_figure = plot_reuse_figure
+        self.plot_add_logo = plot_add_logo
         self.plot_data = plot_data
         self.datareader = datareader
         self._default_datareader = 'ops_mangopare.readers.MangopareNetCDFReader'
         self.plot_metadata = []
         self.default_email_to = ['fishsoop@unsw.edu.au']
         self.pipe = pipe
+        self.max_workers = max_workers
+        self.max_smtp_connections = max_smtp_connections
+        self.smtp_pool = None
+        self.status_log = None
+        self.plot_processes = plot_processes
+        self.plot_pool = None
+        self.n_plot_processes = 0
+        self.prefetch = prefetch
+        self.read_chunk_size = read_chunk_size
+        self.stage_times = {}
+        self._lock = threading.Lock()
         self.logger = logger
 
     def set_cycle(self, cycle_dt):
@@ -114,7 +211,7 @@ class SendDataWrapper(object):
         self.logger.error('Using class: %s ' % klass)
         return(out_class)
 
-    def _get_email_addresses(self):
+    def _get_email_addresses(self, attrs):
         """
         Get to and from email addresses
         """
@@ -123,19 +220,20 @@ class SendDataWrapper(object):
             "(^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$)")
         if not self.email_to:
             try:
-                ds_email_to = self.ds.attrs['vessel_email'].split(",")
+                ds_email_to = attrs['vessel_email'].split(",")
                 ds_email_to = [email.strip() for email in ds_email_to]
-                self.email_to_final = []
-                [self.email_to_final.append(
+                email_to_final = []
+                [email_to_final.append(
                     email) for email in ds_email_to if email_pattern.match(email)]
                 
-                self.logger.error(f'email addresses to send to: {self.email_to_final}')    
+                self.logger.error(f'email addresses to send to: {email_to_final}')    
             except Exception as exc:
                 self.logger.error(
                     'No to email found, using default email address')
-                self.email_to_final = self.default_email_to
+                email_to_final = self.default_email_to
         else:
-            self.email_to_final = self.email_to
+            email_to_final = self.email_to
+        return(email_to_final)
 
     def _set_all_classes(self):
         self.logger.error('In wrapper.py: _set_all_classes')
@@ -147,58 +245,479 @@ class SendDataWrapper(object):
                 'Unable to set required classes to read data: {}'.format(exc))
             raise exc
         
-    def _set_logo_file(self):
+    def _set_logo_file(self, attrs):
         self.logger.error('In wrapper.py: _set_logo_file')
+        logo_file = self.logo_file
         try:
-            if self.ds.attrs['programme_name'] == 'Fish-Soop':
-                self.logo_file = 'fsoop_logo.png'
-                self.sensor_name = 'Moana'
+            if attrs['programme_name'] == 'Fish-Soop':
+                logo_file = 'fsoop_logo.png'
         except:
             pass
+        return(logo_file)
+
+    def _read_stage(self, item):
+        """
+        Download and read the file, start archiving the csv, and decide
+        whether it should be emailed at all.  Files already in the
+        derived store are not read at all.
+        """
+        filename = item['filename']
+        self.logger.error(f'In wrapper.py: _read_stage for {filename}')
+        self._head_input(item)
+        if self.email_raw_data:
+            save_csv = True
+        else:
+            save_csv = False
+        reader_kwargs = {}
+        if self.read_chunk_size:
+            reader_kwargs['chunk_size'] = self.read_chunk_size
+        if 'etag' in item:
+            # the reader does not need to HEAD the file again
+            reader_kwargs['etag'] = item['etag']
+            reader_kwargs['size'] = item['size']
+        reader = self.datareader(
+            filename, save_csv=save_csv,logger=self.logger, **reader_kwargs)
+        item['reader'] = reader
+        # the header check first, so files that will not be emailed
+        # never cost a claim and its release
+        if not self._worth_reading(reader, filename):
+            item['skip'] = True
+            return(item)
+        if not self._claim_input(item):
+            item['skip'] = True
+            return(item)
+        if self._load_derived(item, reader):
+            item['skip'] = not self._should_email(item['attrs'], item['summary'].n)
+            return(item)
+        ds, csv_file = reader.run()
+        item['ds'] = ds
+        item['attrs'] = ds.attrs
+        item['csv_file'] = csv_file
+        item['artifacts'] = list(csv_file)
+        item['skip'] = not self._should_email(ds.attrs, ds.sizes['DATETIME'])
+        if not item['skip']:
+            # one pass over the data for both the plot and the email,
+            # already made while reading in chunk_size mode
+            item['summary'] = getattr(reader, 'summary', None)
+            if item['summary'] is None:
+                item['summary'] = DeploymentSummary(ds, logger=self.logger)
+        return(item)
+
+    def _should_email(self, attrs, n):
+        """
+        Only nrt files with emails on, and more than cutoff_num
+        measurements (i.e. filter out splashed sensors)
+        """
+        if not (attrs['email_frequency'] == 'nrt' and attrs['email_status'] == 'on'):
+            return(False)
+        return(n > self.cutoff_num)
+
+    def _derived_params(self, reader):
+        """
+        Everything besides the input file that changes its csv, plot or
+        summary
+        """
+        params = {name: getattr(reader, name, None) for name in READER_PARAMS}
+        params['reader'] = f'{type(reader).__module__}.{type(reader).__name__}'
+        params['plot_data'] = self.plot_data
+        if self.plot_data:
+            params['plot'] = render_params(**self._plot_kwargs(self.logo_file))
+            params['plot']['logo_file'] = self.logo_file
+        return(params)
+
+    def _load_derived(self, item, reader):
+        """
+        Look the file up in the derived store.  On a hit, the item gets
+        the stored attributes, summary, csv and plot and True is
+        returned; on a miss the key is kept so _finish can store what
+        this run makes.
+        """
+        filename = item['filename']
+        if not self.derived or 'etag' not in item:
+            return(False)
+        try:
+            bucket_name, key = split_s3_path(filename)
+            digest = self.derived.digest(bucket_name, key, item['etag'],
+                                         self._derived_params(reader))
+            derived = self.derived.load(digest)
+        except ClientError as exc:
+            self.logger.error(f'Could not check derived store for {filename} due to {exc}')
+            return(False)
+        if derived is None:
+            item['derived_digest'] = digest
+            return(False)
+        self.logger.error(f'In wrapper.py: using stored csv and plot for {filename}')
+        artifacts = derived['artifacts']
+        item['derived'] = True
+        item['attrs'] = derived['attrs']
+        item['summary'] = derived['summary']
+        item['csv_file'] = [artifacts['csv']] if 'csv' in artifacts else []
+        item['plot_file'] = artifacts.get('plot')
+        # already archived when they were made
+        item['artifacts'] = []
+        return(True)
+
+    def _save_derived(self, item):
+        """
+        Store what was made for a file in the derived store, if it is
+        complete and archived.  Stored whether or not the email went
+        out, so a retry after a failed send does not read or plot the
+        file again.
+        """
+        artifacts = {}
+        csv_file = [a for a in item.get('csv_file', []) if isinstance(a, Artifact)]
+        if self.email_raw_data and not csv_file:
+            return
+        if csv_file:
+            artifacts['csv'] = csv_file[0]
+        if self.plot_data:
+            if not isinstance(item.get('plot_file'), Artifact):
+                return
+            artifacts['plot'] = item['plot_file']
+        try:
+            # the entry points at the archived copies, so they must exist
+            for artifact in artifacts.values():
+                if artifact.future is None:
+                    return
+                artifact.wait()
+            self.derived.save(item['derived_digest'], item['attrs'], item['summary'], artifacts)
+        except Exception as exc:
+            self.logger.error(
+                f'Could not store derived artifacts for {item["filename"]} due to {exc}')
+
+    def _worth_reading(self, reader, filename):
+        """
+        Use the reader's header-only peek (if it has one) to reject
+        files that will not be emailed before any data is downloaded:
+        not nrt/on, or no more than cutoff_num measurements even before
+        QC filtering.  Anything the header cannot decide is read.
+        """
+        if not hasattr(reader, 'peek'):
+            return(True)
+        attrs, sizes = reader.peek()
+        if attrs is None or 'email_frequency' not in attrs or 'email_status' not in attrs:
+            return(True)
+        if not (attrs['email_frequency'] == 'nrt' and attrs['email_status'] == 'on'):
+            self.logger.error(f'In wrapper.py: {filename} is not set to be emailed, not reading it')
+            return(False)
+        if sizes.get('DATETIME', self.cutoff_num + 1) <= self.cutoff_num:
+            self.logger.error(f'In wrapper.py: {filename} has too few measurements, not reading it')
+            return(False)
+        return(True)
+
+    def _plot_stage(self, item):
+        self.logger.error(f'In wrapper.py: _plot_stage for {item["filename"]}')
+        item['plot_list'] = []
+        if item['skip'] or not self.plot_data:
+            return(item)
+        if item.get('derived'):
+            plot_file = item['plot_file']
+        else:
+            plot_file, time_vals = self._plot(item['ds'], item['filename'],
+                                              self._set_logo_file(item['attrs']),
+                                              item['summary'])
+            item['plot_file'] = plot_file
+            item['artifacts'].append(plot_file)
+        if self.email_raw_data:
+            item['plot_list'] = [plot_file]
+            self.logger.error(f'In wrapper.py: run, adding plot: {item["plot_list"]}')
+        return(item)
+
+    def _send_stage(self, item):
+        self.logger.error(f'In wrapper.py: _send_stage for {item["filename"]}')
+        if item['skip']:
+            return(item)
+        email_to_final = self._get_email_addresses(item['attrs'])
+        if self.email_plot or self.email_raw_data:
+            item['sent'] = MangopareMailer(ds=item.get('ds'),
+                                           plots=item['plot_list'],
+                                           from_email=self.email_from,
+                                           bcc=self.bcc_emails,
+                                           additional_attachments=item['csv_file'],
+                                           recipients=email_to_final,
+                                           reply_to=self.email_reply_to,
+                                           status_file=self.status_file,
+                                           create_status_file=self.create_status_file,
+                                           smtp_pool=self.smtp_pool,
+                                           status_log=self.status_log,
+                                           summary=item['summary'],
+                                           attrs=item['attrs'],
+                                           logger=self.logger).run()
+        else:
+            # nothing to email, the file is done with
+            item['sent'] = True
+        return(item)
+
+    def _head_input(self, item):
+        """
+        HEAD an S3 input file once, for the ETag and size that the
+        ledger, the derived store and the reader all need
+        """
+        filename = item['filename']
+        if not (self.ledger or self.derived) or not filename.startswith('s3://'):
+            return
+        try:
+            bucket_name, key = split_s3_path(filename)
+            head = get_s3_client().head_object(Bucket=bucket_name, Key=key)
+        except ClientError as exc:
+            self.logger.error(f'Could not check {filename} for duplicates due to {exc}')
+            return
+        item['etag'] = head['ETag']
+        item['size'] = head['ContentLength']
+
+    def _claim_input(self, item):
+        """
+        Check the input file against the ledger before reading it.
+        Returns False if it was already emailed, or is in progress here
+        or in another invocation.
+        """
+        filename = item['filename']
+        if not self.ledger or 'etag' not in item:
+            return(True)
+        bucket_name, key = split_s3_path(filename)
+        input_id = self.ledger.input_id(key, item['etag'])
+        if self.ledger.seen_recently(input_id):
+            self.logger.error(f'In wrapper.py: {filename} was just handled here, skipping')
+            return(False)
+        if self.ledger.input_done(input_id):
+            self.logger.error(f'In wrapper.py: {filename} has already been emailed, skipping')
+            return(False)
+        if not self.ledger.claim_input(input_id):
+            self.logger.error(f'In wrapper.py: {filename} is being processed elsewhere, skipping')
+            return(False)
+        item['input_id'] = input_id
+        return(True)
+
+    def _finish(self, item, ok=True):
+        """
+        Last step for every file, sent, skipped or failed: wait for its
+        uploads, release the dataset and artifacts and settle its claim
+        in the ledger
+        """
+        self._wait_for_archives(item.get('artifacts', []))
+        if ok and not item.get('skip') and 'derived_digest' in item:
+            self._save_derived(item)
+        self._close_artifacts(item.get('artifacts', []))
+        self._close_dataset(item)
+        if 'input_id' not in item:
+            return
+        try:
+            if ok and item.get('sent'):
+                self.ledger.mark_input_done(item['input_id'])
+            else:
+                # failed, or not emailed this time (e.g. email_status
+                # off): let a later delivery try again
+                self.ledger.release_input(item['input_id'])
+        except (ClientError, BotoCoreError) as exc:
+            self.logger.error(
+                f'Could not update ledger for {item["filename"]} due to {exc}')
+
+    def _close_dataset(self, item):
+        """
+        Release the file behind the item's dataset, through the reader
+        if it can close itself
+        """
+        reader = item.pop('reader', None)
+        ds = item.pop('ds', None)
+        try:
+            if hasattr(reader, 'close'):
+                reader.close()
+            elif ds is not None:
+                ds.close()
+        except Exception as exc:
+            self.logger.error(
+                f'Could not close {item["filename"]} due to {exc}')
+
+    def _add_stage_time(self, stage, filename, seconds):
+        self.logger.error(f'In wrapper.py: {stage} stage took {seconds:.2f} s for {filename}')
+        with self._lock:
+            self.stage_times[stage] = self.stage_times.get(stage, 0.) + seconds
+
+    def _finish_safely(self, item, ok=True):
+        """
+        _finish that never raises, for the stage workers.  Returns
+        False if finishing failed.
+        """
+        try:
+            self._finish(item, ok)
+            return(True)
+        except Exception as exc:
+            self.logger.error(f'Could not finish {item.get("filename")} due to {exc}')
+            return(False)
+
+    def _stage_worker(self, stage, func, in_queue, out_queue, success_files):
+        """
+        Take files from in_queue, run func on them and pass them to
+        out_queue, or finish them if this is the last stage.  A file
+        that fails is finished straight away and goes no further.
+        Nothing a file does can stop the worker before _DONE: a dead
+        worker would leave the stage before it blocked on a full queue.
+        """
+        while True:
+            item = in_queue.get()
+            if item is _DONE:
+                return
+            try:
+                self._run_stage(stage, func, item, out_queue, success_files)
+            except Exception as exc:
+                self.logger.error(f'In wrapper.py: {stage} stage failed for {item.get("filename")} due to {exc}')
+
+    def _run_stage(self, stage, func, item, out_queue, success_files):
+        filename = item['filename']
+        t0 = time.perf_counter()
+        try:
+            item = func(item)
+        except Exception as exc:
+            self.logger.error(
+                f'Send email failed for {filename} due to {exc}.')
+            self._finish_safely(item, ok=False)
+            return
+        finally:
+            self._add_stage_time(stage, filename, time.perf_counter() - t0)
+        if out_queue is not None:
+            out_queue.put(item)
+            return
+        if self._finish_safely(item):
+            with self._lock:
+                success_files.append(filename)
+
+    def _plot_kwargs(self, logo_file, summary=None):
+        return({'logo_file': logo_file, 'out_dir': self.plot_out_dir,
+                'add_map': self.plot_add_map, 'max_points': self.plot_max_points,
+                'render_mode': self.plot_render_mode,
+                'reuse_figure': self.plot_reuse_figure, 'add_logo': self.plot_add_logo,
+                'summary': summary})
+
+    def _plot(self, ds, filename, logo_file, summary=None):
+        """
+        Plot ds in the process pool if there is one, otherwise in this
+        process, one file at a time
+        """
+        self.logger.error(f'In wrapper.py: _plot for {filename}')
+        kwargs = self._plot_kwargs(logo_file, summary)
+        if self.plot_pool:
+            try:
+                plot_file, time_vals = self.plot_pool.submit(
+                    render_plot, plot_inputs(ds), filename, **kwargs).result()
+                if plot_file:
+                    name, data, bucket_name, key = plot_file
+                    plot_file = Artifact(name, data, 'image/png', bucket_name=bucket_name,
+                                         key=key, logger=self.logger).archive()
+                return(plot_file, time_vals)
+            except BrokenProcessPool as exc:
+                self.logger.error(
+                    f'Plot process pool failed ({exc}), plotting {filename} in-process')
+        with _PLOT_LOCK:
+            return(PlotMangopare(ds=ds, filename=filename, logger=self.logger, **kwargs).run())
+
+    def _start_plot_pool(self):
+        """
+        Process pool for plotting, or None if plot_processes is not set
+        or the platform cannot run one
+        """
+        if not (self.plot_processes and self.plot_data):
+            return(None)
+        if self.plot_processes is True:
+            try:
+                n_processes = len(os.sched_getaffinity(0))
+            except AttributeError:
+                n_processes = os.cpu_count() or 1
+        else:
+            n_processes = int(self.plot_processes)
+        n_processes = max(1, min(n_processes, len(self.filelist)))
+        try:
+            # forkserver, so the workers do not inherit the threads
+            # (and their locks) of this process
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else None
+            pool = ProcessPoolExecutor(max_workers=n_processes,
+                                       mp_context=multiprocessing.get_context(method))
+        except (OSError, NotImplementedError, ImportError) as exc:
+            self.logger.error(
+                f'Could not start plot process pool ({exc}), plotting in-process')
+            return(None)
+        self.logger.error(f'In wrapper.py: plotting in {n_processes} processes')
+        self.n_plot_processes = n_processes
+        return(pool)
+
+    def _wait_for_archives(self, artifacts):
+        """
+        The csv and plot are uploaded to S3 in the background while
+        the email is sent; make sure that has finished before the
+        Lambda returns and gets frozen
+        """
+        for artifact in artifacts:
+            if not isinstance(artifact, Artifact):
+                continue
+            try:
+                artifact.wait()
+            except Exception as exc:
+                self.logger.error(
+                    f'Could not archive {artifact} due to {exc}')
+
+    def _close_artifacts(self, artifacts):
+        """
+        Release the temporary files behind artifacts (e.g. the csv)
+        """
+        for artifact in artifacts:
+            if not isinstance(artifact, Artifact):
+                continue
+            try:
+                artifact.close()
+            except Exception as exc:
+                self.logger.error(
+                    f'Could not close {artifact} due to {exc}')
 
     def run(self):
         self.logger.error('In wrapper.py: run')
-        plot_list = []
+        success_files = []
         self._set_filelist()
         self._set_all_classes()
         self.logger.info(
             f'Attemping to send emails for the following files: {self.filelist}')
+        if not self.filelist:
+            return(success_files)
+        self.plot_pool = self._start_plot_pool()
+        self.stage_times = {stage: 0. for stage in STAGES}
+        n_workers = {'read': self.max_workers,
+                     'plot': self.n_plot_processes or 1,
+                     'send': self.max_smtp_connections}
+        funcs = {'read': self._read_stage, 'plot': self._plot_stage,
+                 'send': self._send_stage}
+        # the file list feeds the first stage, bounded queues join the others
+        queues = [queue.Queue()] + [queue.Queue(maxsize=max(1, self.prefetch))
+                                    for _ in STAGES[1:]] + [None]
         for filename in self.filelist:
-            try:
-                if self.email_raw_data:
-                    save_csv = True
-                else:
-                    save_csv = False
-                self.ds, csv_file = self.datareader(
-                    filename, save_csv=save_csv,logger=self.logger).run()
-                    
-                if not (self.ds.attrs['email_frequency'] == 'nrt' and self.ds.attrs['email_status'] == 'on'):
-                    continue
-                # don't email if not enough data (i.e. filter out splashed sensors)
-                if len(self.ds.DATETIME.values) <= self.cutoff_num:
-                    continue
-                self._set_logo_file()
-                if self.plot_data:
-                    plot_file, time_vals = PlotMangopare(
-                        ds=self.ds, filename=filename, logo_file=self.logo_file, 
-                        out_dir=self.plot_out_dir, add_map=self.plot_add_map, 
-                        logger=self.logger).run()
-                if self.email_raw_data and self.plot_data:
-                    plot_list = [plot_file]
-                    self.logger.error(f'In wrapper.py: run, adding plot: {plot_list}')
-                self._get_email_addresses()
-                if self.email_plot or self.email_raw_data:
-                    MangopareMailer(ds=self.ds,
-                                    plots=plot_list,
-                                    from_email=self.email_from,
-                                    bcc=self.bcc_emails,
-                                    additional_attachments=csv_file,
-                                    recipients=self.email_to_final,
-                                    reply_to=self.email_reply_to,
-                                    status_file=self.status_file,
-                                    create_status_file=self.create_status_file,
-                                    logger=self.logger).run()
-                self.ds.close()
-            except Exception as exc:
-                self.logger.error(
-                    f'Send email failed for {filename} due to {exc}.')
+            queues[0].put({'filename': filename})
+        self.smtp_pool = SMTPPool(max_connections=self.max_smtp_connections,
+                                  logger=self.logger)
+        # one status log for the run, so it is read at most once
+        self.status_log = StatusLog(legacy_file=self.status_file,
+                                    logger=self.logger) if self.status_file else None
+        stage_threads = {}
+        t0 = time.perf_counter()
+        try:
+            with self.smtp_pool:
+                for i, stage in enumerate(STAGES):
+                    n = max(1, min(n_workers[stage], len(self.filelist)))
+                    threads = [threading.Thread(
+                        target=self._stage_worker, name=f'{stage}-{j}',
+                        args=(stage, funcs[stage], queues[i], queues[i + 1], success_files))
+                        for j in range(n)]
+                    stage_threads[stage] = threads
+                    for thread in threads:
+                        thread.start()
+                # stop each stage once everything before it has finished
+                for i, stage in enumerate(STAGES):
+                    for _ in stage_threads[stage]:
+                        queues[i].put(_DONE)
+                    for thread in stage_threads[stage]:
+                        thread.join()
+        finally:
+            if self.plot_pool:
+                self.plot_pool.shutdown()
+                self.plot_pool = None
+        self.logger.error(
+            'In wrapper.py: run took {:.2f} s, stage times (summed over files): {}'.format(
+                time.perf_counter() - t0,
+                ', '.join(f'{stage} {seconds:.2f} s' for stage, seconds in self.stage_times.items())))
+        return(success_files)